@@ -0,0 +1,200 @@
+# -----------------------------------------------------------
+# 3.  Count trash bags in every downloaded image
+# -----------------------------------------------------------
+# inference.py tries the model on a single image. This script scores every image that
+# download.py saved under data/raw/cluster_*/ and appends one JSON line per image to
+# data/inference/results.jsonl: cluster, image id, number of detected bags, the answer
+# to QUESTION and the model latency.
+#
+# Images are decoded and downscaled on a small thread pool while at most MAX_IN_FLIGHT
+# requests wait on the Moondream endpoint, so neither the CPU nor the model sits idle and
+# memory stays bounded. Images already in the results file are skipped, so an
+# interrupted run picks up where it stopped. Model answers are also cached by image
+# content hash and prompt (see inference_cache.py), so re-scoring an unchanged frame,
+# even after the results file is reset, costs no model call.
+#
+# Near-duplicate frames (same viewpoint, time bucket and look) are scored once; the
+# frames they stand in for are listed in data/inference/duplicates.jsonl (see dedup_frames.py).
+#
+# Set MOONDREAM_ENDPOINT (e.g. http://localhost:2020/v1) to use a local model,
+# otherwise MOONDREAM_TOKEN is used for Moondream Cloud.
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import json, logging, os, threading, time
+
+from PIL import Image
+from tqdm.auto import tqdm
+
+import metrics
+from dedup_frames import select_frames
+from image_store import sha256_file, write_atomic
+from inference_cache import CachedModel, InferenceCache
+
+RAW_DIR      = Path("data/raw")
+RESULTS_PATH = Path("data/inference/results.jsonl")
+DUPLICATES_PATH = Path("data/inference/duplicates.jsonl")
+
+DETECT_PROMPT = "trash bags"
+QUESTION      = "how many trash bags are there?"
+
+MAX_SIDE       = 1024                  # downscale before upload; plenty for detection
+DECODE_WORKERS = 4
+MAX_IN_FLIGHT  = 8                     # concurrent requests to the model
+DEDUP          = True                  # score one frame per viewpoint and time bucket
+
+log = logging.getLogger(__name__)
+
+# results and duplicates files are shared by every batch in the process
+# (the pipeline scores several clusters at once, see pipeline.py)
+_write_lock = threading.Lock()
+
+
+def model_id():
+    """Identifies the model in cache keys: the local endpoint URL or the cloud."""
+    return os.getenv("MOONDREAM_ENDPOINT") or "moondream-cloud"
+
+
+def get_model(cache=None):
+    """Moondream client: local endpoint if MOONDREAM_ENDPOINT is set, else the cloud.
+
+    With a cache, the client is wrapped so repeated calls are answered from it.
+    """
+    import moondream as md
+    endpoint = os.getenv("MOONDREAM_ENDPOINT")
+    if endpoint:
+        model = md.vl(endpoint=endpoint)
+    else:
+        model = md.vl(api_key=os.getenv("MOONDREAM_TOKEN"))
+    return CachedModel(model, model_id(), cache) if cache is not None else model
+
+
+def find_images(raw_dir=RAW_DIR):
+    """All downloaded images as (cluster, image id, path), in a stable order."""
+    found = []
+    for jpg in sorted(Path(raw_dir).glob("cluster_*/*.jpg")):
+        found.append((jpg.parent.name.removeprefix("cluster_"), jpg.stem, jpg))
+    return found
+
+
+def load_image(path, max_side=MAX_SIDE):
+    """Decode a JPEG at reduced size and shrink it so its longer side is max_side."""
+    img = Image.open(path)
+    img.draft("RGB", (max_side, max_side))     # let libjpeg skip detail we'd throw away
+    img = img.convert("RGB")
+    img.thumbnail((max_side, max_side))
+    return img
+
+
+def decode(path, max_side=MAX_SIDE):
+    """Decoded image plus its cache key: file hash and the size it was shrunk to."""
+    with metrics.timer("decode"):
+        return load_image(path, max_side), f"{sha256_file(path)}@{max_side}"
+
+
+def score_image(model, img, image_key=None):
+    """Run detection and the bag-count question on one image."""
+    # a CachedModel takes the precomputed key; a bare model does not
+    kwargs = {"image_key": image_key} if isinstance(model, CachedModel) else {}
+    start = time.perf_counter()
+    detection = model.detect(img, DETECT_PROMPT, **kwargs)
+    detect_s = time.perf_counter() - start
+    answer = model.query(img, QUESTION, **kwargs)
+    metrics.observe("score_image", time.perf_counter() - start)
+    return {
+        "boxes": len(detection["objects"]),
+        "objects": detection["objects"],
+        "answer": answer["answer"],
+        "detect_s": round(detect_s, 3),
+        "latency_s": round(time.perf_counter() - start, 3),
+    }
+
+
+def scored_ids(results_path=RESULTS_PATH):
+    """(cluster, image id) pairs already in the results file."""
+    done = set()
+    if Path(results_path).exists():
+        with open(results_path) as f:
+            for line in f:
+                if line.strip():
+                    r = json.loads(line)
+                    done.add((str(r["cluster"]), str(r["image_id"])))
+    return done
+
+
+def run_batch(images, model, results_path=RESULTS_PATH,
+              decode_workers=DECODE_WORKERS, max_in_flight=MAX_IN_FLIGHT):
+    """Score images and append results as they finish; returns the number scored."""
+    results_path = Path(results_path)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # decoded images waiting for (or inside) a model call, at most
+    slots = threading.BoundedSemaphore(max_in_flight + decode_workers)
+    scored = 0
+
+    def work(cluster, image_id, path, decoded, out):
+        nonlocal scored
+        try:
+            img, image_key = decoded.result()
+            result = score_image(model, img, image_key)
+        except Exception as e:
+            log.warning(f" ! {image_id}: {e}")
+            metrics.count("score_failures")
+            return
+        finally:
+            slots.release()
+        line = json.dumps(dict(cluster=cluster, image_id=image_id, path=str(path), **result))
+        with _write_lock:
+            out.write(line + "\n")
+            out.flush()
+            scored += 1
+
+    with ThreadPoolExecutor(decode_workers) as decoders, \
+            ThreadPoolExecutor(max_in_flight) as callers, \
+            open(results_path, "a") as out:
+        futures = []
+        for cluster, image_id, path in tqdm(images, unit="img"):
+            slots.acquire()
+            decoded = decoders.submit(decode, path)
+            futures.append(callers.submit(work, cluster, image_id, path, decoded, out))
+        for future in as_completed(futures):
+            future.result()
+    return scored
+
+
+def write_duplicates(duplicates, path=DUPLICATES_PATH, clusters=None):
+    """Record which scored frame stands in for each skipped near-duplicate.
+
+    With `clusters`, only the entries of those clusters are replaced.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    lines = [json.dumps(dict(cluster=c, image_id=i, same_as=rep[1]))
+             for (c, i), rep in sorted(duplicates.items())]
+    with _write_lock:
+        if clusters is not None and path.exists():
+            lines = [line for line in path.read_text().splitlines()
+                     if line.strip() and json.loads(line)["cluster"] not in clusters] + lines
+        write_atomic(path, "".join(line + "\n" for line in lines))
+
+
+def pending_images(images, clusters=None):
+    """Images still to score: near-duplicates dropped (if DEDUP) and scored ones skipped."""
+    if DEDUP:
+        images, duplicates = select_frames(images)
+        write_duplicates(duplicates, clusters=clusters)
+        print(f"Skipping {len(duplicates)} near-duplicate frames")
+    done = scored_ids()
+    todo = [img for img in images if (img[0], img[1]) not in done]
+    print(f"{len(todo)} images to score ({len(done)} already in {RESULTS_PATH})")
+    return todo
+
+
+def main():
+    todo = pending_images(find_images())
+    with InferenceCache() as cache:
+        n = run_batch(todo, get_model(cache))
+    print(f"✅  Scored {n} images -> {RESULTS_PATH}")
+
+
+if __name__ == "__main__":
+    metrics.run(main)
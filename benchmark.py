@@ -0,0 +1,329 @@
+# -----------------------------------------------------------
+# Benchmark the analysis stages on synthetic citywide 311 exports
+# -----------------------------------------------------------
+# The repo ships one 5k-row export, which says little about how the scripts scale.
+# generate_csv() writes a synthetic export with the same 41 columns: every row copies a
+# real complaint (borough, status, address...) and moves it. HOTSPOT_SHARE of the rows
+# pile up within a few feet of a few hot addresses, like repeat complaints at one
+# building; the rest are spread around the real complaints across the five boroughs.
+#
+# Each size runs in a fresh process and times the stages the scripts go through: CSV
+# load, reprojection, DBSCAN (single process and sharded), buffer(25).union_all() and its replacements (envelope from
+# the coordinates, per-cluster footprints), top-N bboxes and the folium map.
+# Wall time and peak RSS of every stage (summed over the process and its pool workers)
+# are appended to data/bench/results.jsonl.
+#
+# --check compares dbscan_labels, dbscan_sharded and ClusterState.labels with sklearn's
+# DBSCAN (a dev dependency) on random point sets, including points exactly eps apart.
+#
+#   python benchmark.py                   # SIZES
+#   python benchmark.py 10000 10000000    # any row counts
+#   python benchmark.py --check           # label equivalence with sklearn
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+import json, multiprocessing, os, resource, subprocess, sys, threading, time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from pyproj import Transformer
+
+from complaints import CREATED_FORMAT, CSV_COLUMNS, CSV_PATH, load_complaints
+
+BENCH_DIR    = Path("data/bench")
+RESULTS_PATH = BENCH_DIR / "results.jsonl"
+SIZES        = (10_000, 100_000, 1_000_000)
+
+HOTSPOT_SHARE  = 0.4                   # rows that belong to a hot address
+HOTSPOT_ROWS   = 200                   # average rows per hot address
+HOTSPOT_FT     = 15                    # spread around a hot address
+BACKGROUND_FT  = 800                   # spread around a real complaint
+CHUNK_ROWS     = 500_000               # rows generated and written at a time
+DAYS           = 365                   # created dates fall in the last year
+
+BUFFER_UNION_MAX_ROWS = 1_000_000      # buffer + union_all takes minutes past this
+TOP_N      = 3
+RSS_POLL_SEC = 0.005
+PIDS_POLL_SEC = 0.1                    # how often new pool workers are looked for
+CHECK_TRIALS = 40
+
+
+def _to_latlon():
+    return Transformer.from_crs("EPSG:2263", "EPSG:4326", always_xy=True)
+
+
+def generate_csv(path, rows, seed=0, template=CSV_PATH):
+    """Write a synthetic 311 export with `rows` complaints; returns the path."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    base = pd.read_csv(template, dtype=str, keep_default_na=False)
+    anchors = load_complaints(template, columns=("x", "y"))
+    # real rows that have coordinates, in the same order as the cached columns
+    base = base[(base["Latitude"] != "") & (base["Longitude"] != "")].reset_index(drop=True)
+    anchor_xy = np.column_stack([anchors["x"], anchors["y"]])
+
+    n_hot = max(1, round(rows * HOTSPOT_SHARE / HOTSPOT_ROWS))
+    hot = rng.integers(len(base), size=n_hot)
+    to_latlon = _to_latlon()
+    end = np.datetime64("2025-06-21T00:00:00", "s")
+
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", newline="") as f:
+        for start in range(0, rows, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, rows - start)
+            is_hot = rng.random(n) < HOTSPOT_SHARE
+            src = np.where(is_hot, hot[rng.integers(n_hot, size=n)], rng.integers(len(base), size=n))
+            spread = np.where(is_hot, HOTSPOT_FT, BACKGROUND_FT)[:, None]
+            xy = anchor_xy[src] + rng.normal(size=(n, 2)) * spread
+            lon, lat = to_latlon.transform(xy[:, 0], xy[:, 1])
+            created = end - rng.integers(DAYS * 86_400, size=n).astype("timedelta64[s]")
+
+            chunk = base.iloc[src].reset_index(drop=True)
+            chunk["Unique Key"] = 70_000_000 + start + np.arange(n)
+            chunk["Created Date"] = pd.Series(created).dt.strftime(CREATED_FORMAT)
+            chunk["X Coordinate (State Plane)"] = np.round(xy[:, 0]).astype(np.int64)
+            chunk["Y Coordinate (State Plane)"] = np.round(xy[:, 1]).astype(np.int64)
+            chunk["Latitude"] = lat
+            chunk["Longitude"] = lon
+            chunk["Location"] = [f"({a}, {b})" for a, b in zip(lat, lon)]
+            chunk.to_csv(f, header=start == 0, index=False)
+    os.replace(tmp, path)
+    return path
+
+
+def synthetic_csv(rows, seed=0):
+    """Path of the synthetic export for `rows`, generated on first use."""
+    path = BENCH_DIR / f"synthetic_{rows}_{seed}.csv"
+    if not path.exists():
+        print(f"Generating {rows:,} rows -> {path}")
+        generate_csv(path, rows, seed)
+    return path
+
+
+def _descendants():
+    """Pids of this process and every process below it (pool workers), from /proc."""
+    children = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):     # exited while listing
+                continue
+            children.setdefault(ppid, []).append(int(name))
+    pids, todo = [], [os.getpid()]
+    while todo:
+        pids.append(todo.pop())
+        todo += children.get(pids[-1], [])
+    return pids
+
+
+def _rss_bytes(pids):
+    pages = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                pages += int(f.read().split()[1])
+        except OSError:                       # a worker that exited
+            pass
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRSS:
+    """Samples the resident set size of the process and its children on a thread.
+
+    Pages shared between processes count once per process, so this is an upper bound.
+    Without /proc (macOS), falls back to the high-water marks of the process and of its
+    largest child that has exited.
+    """
+
+    def __enter__(self):
+        self.peak = 0
+        self.stop = threading.Event()
+        self.sampler = None
+        if Path("/proc/self/statm").exists():
+            self.peak = _rss_bytes(_descendants())
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+        return self
+
+    def _sample(self):
+        pids, listed = _descendants(), time.monotonic()
+        while not self.stop.wait(RSS_POLL_SEC):
+            # listing /proc costs more than reading a few statm files: refresh it less often
+            if time.monotonic() - listed >= PIDS_POLL_SEC:
+                pids, listed = _descendants(), time.monotonic()
+            self.peak = max(self.peak, _rss_bytes(pids))
+
+    def __exit__(self, *exc):
+        if self.sampler is None:
+            maxrss = sum(resource.getrusage(who).ru_maxrss
+                         for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+            self.peak = maxrss if sys.platform == "darwin" else maxrss * 1024
+        else:
+            self.stop.set()
+            self.sampler.join()
+            self.peak = max(self.peak, _rss_bytes(_descendants()))
+
+    @property
+    def mb(self):
+        return round(self.peak / 2**20, 1)
+
+
+def bench_stages(csv_path):
+    """Run every stage once on one export; returns one record per stage."""
+    from clustering import dbscan_labels
+    from sharded_clustering import dbscan_sharded
+    from find_top_clusters import BUFFER_FT, latlon_bbox
+    from hot_areas import cluster_footprints, envelope_bounds
+    from map_layers import add_points, cluster_sizes
+    import folium
+
+    records = []
+
+    def timed(stage, fn):
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            out = fn()
+            wall = time.perf_counter() - start
+        records.append(dict(stage=stage, wall_s=round(wall, 3), peak_rss_mb=rss.mb))
+        print(f"  {stage:<14} {wall:8.2f} s {rss.mb:9.1f} MB")
+        return out
+
+    df = timed("csv_load", lambda: pd.read_csv(csv_path, usecols=list(CSV_COLUMNS),
+                                               dtype=CSV_COLUMNS)
+                                   .dropna(subset=["Longitude", "Latitude"]))
+    lon = df["Longitude"].to_numpy(np.float64)
+    lat = df["Latitude"].to_numpy(np.float64)
+    del df
+    to_ft = Transformer.from_crs("EPSG:4326", "EPSG:2263", always_xy=True)
+    x, y = timed("reproject", lambda: to_ft.transform(lon, lat))
+    xy = np.column_stack([x, y])
+
+    labels = timed("dbscan", lambda: dbscan_labels(xy))
+    sharded = timed("dbscan_sharded", lambda: dbscan_sharded(xy, queue_dir=None))
+    if not np.array_equal(sharded, labels):
+        raise RuntimeError("sharded DBSCAN labels differ from the single-process run")
+    del sharded
+
+    if len(xy) <= BUFFER_UNION_MAX_ROWS:
+        points = gpd.GeoSeries(gpd.points_from_xy(x, y), crs="EPSG:2263")
+        timed("buffer_union", lambda: points.buffer(25).union_all().envelope.bounds)
+        del points
+    else:
+        print(f"  {'buffer_union':<14} skipped (> {BUFFER_UNION_MAX_ROWS:,} rows)")
+    # what visualize_reports.py does instead (see hot_areas.py)
+    timed("envelope", lambda: envelope_bounds(xy))
+    ids = np.unique(labels[labels != -1])
+    timed("footprints", lambda: cluster_footprints(xy, labels, ids))
+
+    def top_bboxes():
+        sizes = np.bincount(labels[labels != -1])
+        out = []
+        for cid in np.argsort(-sizes, kind="stable")[:TOP_N]:
+            members = xy[labels == cid]
+            out.append(latlon_bbox(*(members.min(axis=0) - BUFFER_FT),
+                                   *(members.max(axis=0) + BUFFER_FT)))
+        return out
+    timed("top_n_bbox", top_bboxes)
+
+    def build_map():
+        m = folium.Map(location=[lat.mean(), lon.mean()], zoom_start=12)
+        noise = labels == -1
+        add_points(m, lat[noise], lon[noise], colors=["gray"], radius=2, fill_opacity=0.3)
+        sizes = cluster_sizes(labels)
+        add_points(m, lat[~noise], lon[~noise], colors=["red", "blue", "green", "purple", "orange"],
+                   groups=labels[~noise] % 5,
+                   popups=[f"Cluster {c}<br>Size: {n} points" for c, n in enumerate(sizes[:5])])
+        return len(m.get_root().render())
+    html_bytes = timed("map_build", build_map)
+    records[-1]["html_mb"] = round(html_bytes / 2**20, 1)
+
+    for r in records:
+        r.update(points=len(xy), clusters=int(labels.max()) + 1)
+    return records
+
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(sizes=SIZES, seed=0, results_path=RESULTS_PATH):
+    """Benchmark every size in its own process and append the records to results_path."""
+    results_path = Path(results_path)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    run = dict(run=datetime.now(timezone.utc).isoformat(timespec="seconds"), rev=git_rev(),
+               cpus=os.cpu_count())
+    ctx = multiprocessing.get_context("spawn")
+    records = []
+    for rows in sizes:
+        csv_path = synthetic_csv(rows, seed)
+        print(f"\n{rows:,} rows")
+        # a fresh process per size, so memory from one size does not carry into the next
+        with ProcessPoolExecutor(1, mp_context=ctx) as proc:
+            stages = proc.submit(bench_stages, csv_path).result()
+        with open(results_path, "a") as f:
+            for r in stages:
+                record = dict(run, rows=rows, seed=seed, **r)
+                f.write(json.dumps(record) + "\n")
+                records.append(record)
+    print(f"\n✅  {len(records)} timings appended to {results_path}")
+    return records
+
+
+def random_points(rng, n, eps):
+    """n points in a few dense spots and a sparse background, every other set on a
+    lattice where many pairs are exactly eps apart (3-4-5 offsets)."""
+    spots = rng.uniform(0, 40 * eps, size=(rng.integers(1, 6), 2))
+    xy = np.concatenate([spots[rng.integers(len(spots), size=n // 2)]
+                         + rng.normal(size=(n // 2, 2)) * eps,
+                         rng.uniform(0, 40 * eps, size=(n - n // 2, 2))])
+    if rng.random() < 0.5:
+        step = eps / 5                         # (3, 4) steps are eps apart
+        xy = np.round(xy / step) * step
+    return xy
+
+
+def check_labels(trials=CHECK_TRIALS, seed=0, eps=30, min_samples=5):
+    """Raise RuntimeError unless every DBSCAN variant returns sklearn's labels."""
+    from sklearn.cluster import DBSCAN
+    from clustering import dbscan_labels
+    from incremental_clusters import ClusterState, add_points
+    from sharded_clustering import dbscan_sharded
+
+    rng = np.random.default_rng(seed)
+    for trial in range(trials):
+        xy = random_points(rng, int(rng.integers(50, 3000)), eps)
+        expected = DBSCAN(eps=eps, min_samples=min_samples).fit(xy).labels_
+
+        # incremental: the same points added in random order and batches
+        keys = rng.permutation(len(xy)) + 1000
+        state = ClusterState.empty(eps, min_samples)
+        for batch in np.array_split(rng.permutation(len(xy)), rng.integers(1, 6)):
+            state = add_points(state, xy[batch], keys[batch])
+
+        got = {
+            "dbscan_labels": dbscan_labels(xy, eps, min_samples, chunk_size=int(rng.integers(1, 500))),
+            "dbscan_sharded": dbscan_sharded(xy, eps, min_samples, tile_ft=8 * eps, n_jobs=2,
+                                             queue_dir=None),
+            "ClusterState.labels": state.labels(keys),
+        }
+        for name, labels in got.items():
+            if not np.array_equal(labels, expected):
+                raise RuntimeError(f"{name} differs from sklearn on trial {trial} "
+                                   f"({len(xy)} points, seed {seed})")
+    print(f"✅  {trials} trials: every DBSCAN variant matches sklearn")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--check"]:
+        check_labels(*[int(n) for n in sys.argv[2:3]])
+    else:
+        run_benchmark([int(n) for n in sys.argv[1:]] or SIZES)
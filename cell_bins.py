@@ -0,0 +1,240 @@
+# -----------------------------------------------------------
+# Complaint counts per grid cell and time bucket
+# -----------------------------------------------------------
+# Most dashboard questions ("where are complaints piling up this month?") only need
+# counts per area, not clusters. Projected x/y are binned into square or hexagonal
+# cells of several sizes (GRIDS) with plain NumPy arithmetic, and each grid keeps one
+# count per (cell, time bucket of BUCKET_DAYS). The counts are saved under
+# data/cell_counts/, next to one key set shared by all grids: the Unique Keys counted
+# and the path of their CSV. A refresh only bins the complaints not counted yet, and
+# writes nothing when there are none. If a counted complaint is missing from the
+# export, or the CSV path changed, the grids are counted from scratch. Every save
+# stamps the grids and the key set alike, so grids left from an interrupted save
+# do not match the key set and are recounted.
+# Top-K cells for any time range are a sum over buckets plus a partial sort, which
+# takes milliseconds even for citywide history.
+#
+# Square cells have side `size` ft. Hex cells are pointy-top with `size` ft from the
+# center to each corner.
+
+from dataclasses import dataclass
+from pathlib import Path
+import os, uuid
+
+import numpy as np
+from pyproj import Transformer
+import shapely
+
+from complaints import CSV_PATH, load_complaints
+
+GRID_DIR    = Path("data/cell_counts")
+KEYS_FILE   = "keys.npz"               # Unique Keys every grid has counted, and their CSV
+GRIDS       = (("square", 100), ("square", 500), ("hex", 150), ("hex", 1000))
+BUCKET_DAYS = 7
+
+_SQRT3 = np.sqrt(3.0)
+_OFFSET = 1 << 30                      # keeps packed cell coordinates non-negative
+
+
+def _pack(a, b):
+    return ((a.astype(np.int64) + _OFFSET) << 32) | (b.astype(np.int64) + _OFFSET)
+
+
+def _unpack(cells):
+    cells = np.asarray(cells, dtype=np.int64)
+    return (cells >> 32) - _OFFSET, (cells & 0xFFFFFFFF) - _OFFSET
+
+
+def square_cells(xy, size):
+    """Cell id of each point on a grid of size x size ft squares."""
+    ij = np.floor(np.asarray(xy, dtype=np.float64) / size)
+    return _pack(ij[:, 0], ij[:, 1])
+
+
+def hex_cells(xy, size):
+    """Cell id of each point on a pointy-top hex grid (axial coordinates, cube rounding)."""
+    xy = np.asarray(xy, dtype=np.float64)
+    q = (_SQRT3 / 3 * xy[:, 0] - xy[:, 1] / 3) / size
+    r = (2 / 3 * xy[:, 1]) / size
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return _pack(rq, rr)
+
+
+def time_buckets(created, bucket_days=BUCKET_DAYS):
+    """Bucket index of each datetime: days since 1970-01-01 // bucket_days."""
+    days = np.asarray(created).astype("datetime64[D]").astype(np.int64)
+    return days // bucket_days
+
+
+@dataclass
+class CellCounts:
+    """Counts per (cell, time bucket) on one grid, sorted by cell then bucket."""
+    kind:        str                   # "square" or "hex"
+    size:        float                 # ft
+    bucket_days: int
+    cells:       np.ndarray            # int64 cell id
+    buckets:     np.ndarray            # int64 time bucket
+    counts:      np.ndarray            # int64 complaints
+
+    @classmethod
+    def empty(cls, kind, size, bucket_days=BUCKET_DAYS):
+        if kind not in ("square", "hex"):
+            raise ValueError(f"Unknown cell kind: {kind}")
+        none = np.empty(0, dtype=np.int64)
+        return cls(kind, float(size), bucket_days, none, none, none)
+
+    @property
+    def name(self):
+        return f"{self.kind}_{self.size:g}"
+
+    def cell_ids(self, xy):
+        return (square_cells if self.kind == "square" else hex_cells)(xy, self.size)
+
+    def add(self, xy, created):
+        """Return new counts with the given points added."""
+        cells = np.concatenate([self.cells, self.cell_ids(xy)])
+        buckets = np.concatenate([self.buckets, time_buckets(created, self.bucket_days)])
+        counts = np.concatenate([self.counts, np.ones(len(cells) - len(self.cells), dtype=np.int64)])
+        if len(cells):
+            order = np.lexsort((buckets, cells))
+            cells, buckets, counts = cells[order], buckets[order], counts[order]
+            starts = np.flatnonzero(np.r_[True, (cells[1:] != cells[:-1]) | (buckets[1:] != buckets[:-1])])
+            cells, buckets, counts = cells[starts], buckets[starts], np.add.reduceat(counts, starts)
+        return CellCounts(self.kind, self.size, self.bucket_days, cells, buckets, counts)
+
+    def totals(self, since=None, until=None):
+        """(cells, counts) summed over the buckets that overlap [since, until)."""
+        keep = np.ones(len(self.cells), dtype=bool)
+        if since is not None:
+            keep &= self.buckets >= time_buckets([np.datetime64(since, "s")], self.bucket_days)[0]
+        if until is not None:
+            keep &= self.buckets <= time_buckets([np.datetime64(until, "s") - 1], self.bucket_days)[0]
+        cells, counts = self.cells[keep], self.counts[keep]
+        if not len(cells):
+            return cells, counts
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        return cells[starts], np.add.reduceat(counts, starts)
+
+    def centers(self, cells):
+        """(n, 2) cell centers in State Plane ft."""
+        a, b = _unpack(cells)
+        if self.kind == "square":
+            return np.column_stack([(a + 0.5) * self.size, (b + 0.5) * self.size])
+        return np.column_stack([self.size * _SQRT3 * (a + b / 2), self.size * 1.5 * b])
+
+    def polygons(self, cells):
+        """Shapely polygon of every cell, in State Plane ft."""
+        c = self.centers(cells)
+        if self.kind == "square":
+            h = self.size / 2
+            return shapely.box(c[:, 0] - h, c[:, 1] - h, c[:, 0] + h, c[:, 1] + h)
+        angles = np.radians(30 + 60 * np.arange(6))
+        corners = c[:, None, :] + self.size * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        return shapely.polygons(corners)
+
+    def top(self, k=10, since=None, until=None):
+        """The k busiest cells: id, count, center and lat/lon bbox (like hot_bboxes)."""
+        cells, counts = self.totals(since, until)
+        if len(cells) > k:
+            pick = np.argpartition(-counts, k - 1)[:k]
+        else:
+            pick = np.arange(len(cells))
+        pick = pick[np.lexsort((cells[pick], -counts[pick]))]
+        bounds = shapely.bounds(self.polygons(cells[pick]))
+        to_latlon = Transformer.from_crs("EPSG:2263", "EPSG:4326", always_xy=True)
+        center = to_latlon.transform(*self.centers(cells[pick]).T)
+        w, s = to_latlon.transform(bounds[:, 0], bounds[:, 1])
+        e, n = to_latlon.transform(bounds[:, 2], bounds[:, 3])
+        return [dict(cell=int(cells[i]), count=int(counts[i]), lat=float(center[1][j]),
+                     lon=float(center[0][j]), west=float(w[j]), south=float(s[j]),
+                     east=float(e[j]), north=float(n[j]))
+                for j, i in enumerate(pick)]
+
+    def heat_points(self, since=None, until=None):
+        """(lat, lon, count) of every non-empty cell, for a heatmap layer."""
+        cells, counts = self.totals(since, until)
+        lon, lat = Transformer.from_crs("EPSG:2263", "EPSG:4326", always_xy=True) \
+            .transform(*self.centers(cells).T)
+        return np.asarray(lat), np.asarray(lon), counts
+
+
+def _save_npz(path, **arrays):
+    tmp = path.with_name(f".{path.name}")
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def save_grids(grids, stamp, grid_dir=GRID_DIR):
+    """Write each grid to <grid_dir>/<kind>_<size>.npz, replacing the file atomically."""
+    grid_dir = Path(grid_dir)
+    grid_dir.mkdir(parents=True, exist_ok=True)
+    for g in grids:
+        _save_npz(grid_dir / f"{g.name}.npz", cells=g.cells, buckets=g.buckets, counts=g.counts,
+                  bucket_days=g.bucket_days, stamp=stamp)
+
+
+def load_grid(kind, size, stamp, grid_dir=GRID_DIR, bucket_days=BUCKET_DAYS):
+    """Saved counts for one grid, or None if there are none for these settings and stamp."""
+    path = Path(grid_dir) / f"{CellCounts.empty(kind, size, bucket_days).name}.npz"
+    if stamp is None or not path.exists():
+        return None
+    with np.load(path) as data:
+        if (int(data["bucket_days"]) != bucket_days or "stamp" not in data
+                or str(data["stamp"]) != stamp):
+            return None
+        return CellCounts(kind, float(size), bucket_days, data["cells"], data["buckets"],
+                          data["counts"])
+
+
+def save_counted(unique_keys, source, stamp, grid_dir=GRID_DIR):
+    """Write the key set the grids saved with stamp have counted."""
+    _save_npz(Path(grid_dir) / KEYS_FILE, unique_keys=unique_keys, source=source, stamp=stamp)
+
+
+def load_counted(source, grid_dir=GRID_DIR):
+    """(sorted Unique Keys, stamp) the grids have counted from source, or (empty, None)."""
+    path = Path(grid_dir) / KEYS_FILE
+    if path.exists():
+        with np.load(path) as data:
+            if str(data["source"]) == source:
+                return data["unique_keys"], str(data["stamp"])
+    return np.empty(0, np.int64), None
+
+
+def refresh_grids(csv_path=CSV_PATH, grid_dir=GRID_DIR, grids=GRIDS, bucket_days=BUCKET_DAYS):
+    """Bin complaints the grids have not counted yet, save and return the grids.
+
+    Like refresh_clusters, the counts belong to one CSV path and are counted
+    from scratch when the export no longer holds every complaint they counted.
+    """
+    source = str(Path(csv_path).resolve())
+    pts = load_complaints(csv_path, columns=("unique_key", "created", "x", "y"))
+    keys = np.asarray(pts["unique_key"])
+    counted, stamp = load_counted(source, grid_dir)
+    known = np.isin(keys, counted, assume_unique=True)
+    if np.count_nonzero(known) != len(counted):
+        counted, stamp = np.empty(0, np.int64), None
+        known[:] = False
+    new = np.flatnonzero(~known)
+
+    out, changed = [], len(new) > 0
+    for kind, size in grids:
+        g = load_grid(kind, size, stamp, grid_dir, bucket_days)
+        rows = new
+        if g is None:                  # not saved with this key set: count every row
+            g, rows, changed = CellCounts.empty(kind, size, bucket_days), np.arange(len(keys)), True
+        if len(rows):
+            g = g.add(np.column_stack([pts["x"][rows], pts["y"][rows]]), pts["created"][rows])
+        out.append(g)
+    if changed:
+        stamp = uuid.uuid4().hex
+        save_grids(out, stamp, grid_dir)
+        save_counted(np.union1d(counted, keys[new]), source, stamp, grid_dir)
+    return out
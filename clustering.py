@@ -0,0 +1,415 @@
+# -----------------------------------------------------------
+# DBSCAN over projected complaint points with a grid-hash index
+# -----------------------------------------------------------
+# find_clusters.py and find_top_clusters.py cluster complaints with DBSCAN(eps=30 ft,
+# min_samples=5). sklearn's DBSCAN keeps every neighborhood in memory at once, which
+# does not fit citywide data. This module gives the same labels with bounded memory:
+# points are hashed into square cells of side eps, so all neighbors of a point lie in
+# the 3x3 block of cells around it, and neighborhoods are visited in chunks spread
+# over a thread pool. Chunks are sized by the candidate pairs they check (PAIR_BUDGET),
+# not only by their number of points, because repeat complaints at one address put
+# thousands of points in a cell. Core points are joined with a vectorized union-find.
+#
+# The labels of the cached complaints are saved next to the complaint cache (see
+# cached_labels), so the scripts that map the same export cluster it only once.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import metrics
+from complaints import CACHE_DIR, CSV_PATH, build_cache, load_columns
+
+EPS_FT      = 30                       # 30 ft = ~9 m
+MIN_SAMPLES = 5
+CHUNK_SIZE  = 100_000                  # query points per neighbor batch
+PAIR_BUDGET = 1_000_000                # candidate pairs per neighbor batch, ~100 MB per thread
+IN_FLIGHT   = 2 * (os.cpu_count() or 1)   # neighbor batches queued or waiting to be consumed
+
+_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+
+def _cell_keys(ix, iy):
+    """Pack integer cell coordinates into one sortable int64 key."""
+    return (ix << 32) + iy
+
+
+class GridIndex:
+    """Points bucketed into square cells, sorted by cell key."""
+
+    def __init__(self, xy, cell, order=None, keys=None):
+        self.xy    = np.ascontiguousarray(xy, dtype=np.float64)
+        self.cell  = float(cell)
+        if order is None:
+            keys  = self.keys_for(self.xy)
+            order = np.argsort(keys, kind="stable")
+            keys  = keys[order]
+        self.order = order
+        self.keys  = keys
+        # occupied cells and the [start, end) slice of self.order each one owns
+        self.starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else keys
+        self.cells  = keys[self.starts]
+        self.ends   = np.append(self.starts[1:], len(keys))[:len(self.starts)]
+
+    def extended(self, new_xy):
+        """Index over these points followed by new_xy, merging instead of re-sorting."""
+        new_xy = np.asarray(new_xy, dtype=np.float64).reshape(-1, 2)
+        keys   = self.keys_for(new_xy)
+        order  = np.argsort(keys, kind="stable")
+        keys   = keys[order]
+        at     = np.searchsorted(self.keys, keys, side="right")
+        return GridIndex(np.concatenate([self.xy, new_xy]), self.cell,
+                         order=np.insert(self.order, at, order + len(self.xy)),
+                         keys=np.insert(self.keys, at, keys))
+
+    def keys_for(self, xy):
+        ij = np.floor(xy / self.cell).astype(np.int64)
+        return _cell_keys(ij[:, 0], ij[:, 1])
+
+    def lookup(self, key):
+        """Position in self.cells of each cell key, and whether that cell has points."""
+        at = np.minimum(np.searchsorted(self.cells, key), len(self.cells) - 1)
+        return at, self.cells[at] == key
+
+    def _block(self, qxy, dx, dy):
+        """Start in self.order and size of the cell at offset (dx, dy) from each query's."""
+        ij = np.floor(qxy / self.cell).astype(np.int64)
+        at, hit = self.lookup(_cell_keys(ij[:, 0] + dx, ij[:, 1] + dy))
+        return np.where(hit, self.starts[at], 0), np.where(hit, self.ends[at] - self.starts[at], 0)
+
+    def around(self, idx):
+        """Indexed points in the 3x3 cells around the points idx, each once."""
+        idx = np.asarray(idx, dtype=np.int64)
+        if len(idx) == 0 or len(self.cells) == 0:
+            return np.empty(0, np.int64)
+        qxy = self.xy[idx]
+        qxy = qxy[np.unique(self.keys_for(qxy), return_index=True)[1]]     # one point per cell
+        found = [self.order[_ranges(*self._block(qxy, dx, dy))] for dx, dy in _OFFSETS]
+        return np.unique(np.concatenate(found))
+
+    def candidates(self, qxy):
+        """Points in the 3x3 cells around each query: the pairs pairs() checks for it."""
+        qxy = np.asarray(qxy, dtype=np.float64)
+        total = np.zeros(len(qxy), dtype=np.int64)
+        if len(self.cells):
+            for dx, dy in _OFFSETS:
+                total += self._block(qxy, dx, dy)[1]
+        return total
+
+    def chunks(self, idx, size=CHUNK_SIZE, budget=PAIR_BUDGET):
+        """Split indexed points idx into query batches of at most size points and
+        budget candidate pairs (a point with more candidates is a batch of its own)."""
+        return _chunks(idx, size, self.candidates(self.xy[idx]), budget)
+
+    def pairs(self, qxy, radius):
+        """Return (query_pos, point_idx) for every indexed point within radius of a query.
+
+        radius must not exceed the cell size. Distances are compared squared,
+        like sklearn's KD-tree, so boundary cases agree with DBSCAN. Queries
+        sorted by cell (see cell_order) hit the lookups far more cheaply.
+        """
+        qxy = np.asarray(qxy, dtype=np.float64)
+        if len(self.cells) == 0:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        r2  = radius * radius
+        found_q, found_p = [], []
+        for dx, dy in _OFFSETS:
+            lo, n = self._block(qxy, dx, dy)
+            if not n.any():
+                continue
+            q   = np.repeat(np.arange(len(qxy)), n)
+            p   = self.order[_ranges(lo, n)]
+            d   = self.xy[p] - qxy[q]
+            near = (d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1]) <= r2
+            found_q.append(q[near])
+            found_p.append(p[near])
+        if not found_q:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        return np.concatenate(found_q), np.concatenate(found_p)
+
+    def boxes(self):
+        """Lower and upper corner of the bounding box of each occupied cell's points."""
+        pts = self.xy[self.order]
+        if len(pts) == 0:
+            return np.empty((0, 2)), np.empty((0, 2))
+        return np.minimum.reduceat(pts, self.starts), np.maximum.reduceat(pts, self.starts)
+
+    def cell_pairs(self, cells, radius):
+        """(a, b, full): every occupied cell b that may hold points within radius of
+        a point of cell a, for a in cells (positions in self.cells).
+
+        full marks pairs where every point of b is within radius of every point
+        of a. Both are decided from the bounding boxes of the cells' points with
+        the same arithmetic as pairs(), so boundary cases are never misjudged.
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        if len(self.cells) == 0:
+            return cells[:0], cells[:0], np.zeros(0, dtype=bool)
+        lo, hi = self.boxes()
+        ij = np.floor(self.xy[self.order[self.starts[cells]]] / self.cell).astype(np.int64)
+        reach = int(np.ceil(radius / self.cell))
+        r2 = radius * radius
+        found_a, found_b, found_full = [], [], []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                b, hit = self.lookup(_cell_keys(ij[:, 0] + dx, ij[:, 1] + dy))
+                a, b = cells[hit], b[hit]
+                gap  = np.maximum(0, np.maximum(lo[b] - hi[a], lo[a] - hi[b]))
+                span = np.maximum(hi[b] - lo[a], hi[a] - lo[b])
+                near = (gap[:, 0] * gap[:, 0] + gap[:, 1] * gap[:, 1]) <= r2
+                full = (span[:, 0] * span[:, 0] + span[:, 1] * span[:, 1]) <= r2
+                found_a.append(a[near])
+                found_b.append(b[near])
+                found_full.append(full[near])
+        return np.concatenate(found_a), np.concatenate(found_b), np.concatenate(found_full)
+
+    def cell_order(self, mask=None):
+        """Point indices sorted by cell, optionally only where mask is True."""
+        return self.order if mask is None else self.order[mask[self.order]]
+
+
+def _ranges(lo, n):
+    """Concatenation of arange(lo[i], lo[i] + n[i]) over i."""
+    return np.arange(int(n.sum())) - np.repeat(np.cumsum(n) - n - lo, n)
+
+
+def _chunks(idx, size, cost, budget=PAIR_BUDGET):
+    """Split idx into chunks of at most size items and budget total cost
+    (an item costing more is a chunk of its own)."""
+    total = np.cumsum(cost)
+    out, start = [], 0
+    while start < len(idx):
+        spent = total[start - 1] if start else 0
+        end = int(np.searchsorted(total, spent + budget, side="right"))
+        end = min(max(end, start + 1), start + size)
+        out.append(idx[start:end])
+        start = end
+    return out
+
+
+def _find(parent, idx):
+    """Vectorized union-find root lookup with path compression."""
+    root = parent[idx]
+    while True:
+        up = parent[root]
+        if np.array_equal(up, root):
+            break
+        root = up
+    parent[idx] = root
+    return root
+
+
+def _union(parent, a, b):
+    """Merge the sets of every (a[i], b[i]) edge; each set's root is its smallest member."""
+    ra, rb = _find(parent, a), _find(parent, b)
+    keep = ra != rb
+    if not keep.any():
+        return
+    ra, rb = ra[keep], rb[keep]
+    nodes, inv = np.unique(np.concatenate([ra, rb]), return_inverse=True)
+    m = len(ra)
+    graph = coo_matrix((np.ones(m, dtype=bool), (inv[:m], inv[m:])),
+                       shape=(len(nodes), len(nodes)))
+    _, comp = connected_components(graph, directed=False)
+    low = np.full(comp.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(low, comp, nodes)
+    parent[nodes] = low[comp]
+
+
+def _fine_grid(xy, radius):
+    """Index over xy in cells of side radius/√2, the diagonal of which is radius."""
+    return GridIndex(xy, radius / np.sqrt(2))
+
+
+def _cell_rows(qcell, a, b):
+    """(query, cell) rows: each query i with qcell[i] == a[k] paired with b[k], by query."""
+    order = np.argsort(qcell, kind="stable")
+    in_order = qcell[order]
+    first = np.searchsorted(in_order, a)
+    n = np.searchsorted(in_order, a, side="right") - first
+    rows_q, rows_b = order[_ranges(first, n)], np.repeat(b, n)
+    by_query = np.argsort(rows_q, kind="stable")
+    return rows_q[by_query], rows_b[by_query]
+
+
+def _row_pairs(grid, rows_q, rows_b, qxy, radius):
+    """(query, point) for every point of cell rows_b[i] within radius of query rows_q[i]."""
+    n = grid.ends[rows_b] - grid.starts[rows_b]
+    q = np.repeat(rows_q, n)
+    p = grid.order[_ranges(grid.starts[rows_b], n)]
+    d = grid.xy[p] - qxy[q]
+    near = (d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1]) <= radius * radius
+    return q[near], p[near]
+
+
+def _map(pool, fn, items):
+    """map(fn, items) on the pool if given, with at most IN_FLIGHT results waiting,
+    so results pile up no faster than the caller consumes them."""
+    if pool is None:
+        yield from map(fn, items)
+        return
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= IN_FLIGHT:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def neighbor_counts(index, idx, radius, chunk_size=CHUNK_SIZE, pool=None):
+    """Number of indexed points (self included) within radius of each point in idx.
+
+    Points are bucketed again into cells of side radius/√2. A cell whose points
+    are all within radius of all points of a query's cell (see cell_pairs) adds
+    its size without distance checks, so a spot of repeat complaints costs one
+    check instead of one per pair; only cells partly within radius are compared
+    point by point.
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    if len(idx) == 0:
+        return np.empty(0, np.int64)
+    fine = _fine_grid(index.xy, radius)
+    qxy = fine.xy[idx]
+    qcell = fine.lookup(fine.keys_for(qxy))[0]
+    a, b, full = fine.cell_pairs(np.unique(qcell), radius)
+    size = fine.ends - fine.starts
+    per_cell = np.zeros(len(fine.cells), dtype=np.int64)
+    np.add.at(per_cell, a[full], size[b[full]])
+    counts = per_cell[qcell]
+
+    rows_q, rows_b = _cell_rows(qcell, a[~full], b[~full])
+    def count(rows):
+        q, _ = _row_pairs(fine, rows_q[rows], rows_b[rows], qxy, radius)
+        start = int(q.min()) if len(q) else 0
+        return start, np.bincount(q - start)
+    chunks = _chunks(np.arange(len(rows_q)), chunk_size, size[rows_b])
+    for start, part in _map(pool, count, chunks):
+        counts[start:start + len(part)] += part
+    return counts
+
+
+def join_cores(index, parent, is_core, idx, radius, chunk_size=CHUNK_SIZE, pool=None):
+    """Union every core point in idx with the core points within radius of it.
+
+    Core points are bucketed into cells of side radius/√2 and each cell's cores
+    are joined to its first one. A query is then joined to the first core of
+    every cell that lies within radius of its cell all over, and compared point
+    by point only with cells partly within radius.
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    cores = np.flatnonzero(is_core)
+    if len(idx) == 0:
+        return
+    fine = _fine_grid(index.xy[cores], radius)
+    qxy = index.xy[idx]
+    qcell = fine.lookup(fine.keys_for(qxy))[0]
+    a, b, full = fine.cell_pairs(np.unique(qcell), radius)
+    # a cell only stands for its first core when all its cores are within radius of each other
+    lo, hi = fine.boxes()
+    span = hi - lo
+    full &= ((span[:, 0] * span[:, 0] + span[:, 1] * span[:, 1]) <= radius * radius)[b]
+
+    first = cores[fine.order[fine.starts]]
+    cells = np.unique(b[full])
+    size = fine.ends - fine.starts
+    members = cores[fine.order[_ranges(fine.starts[cells], size[cells])]]
+    _union(parent, members, np.repeat(first[cells], size[cells]))
+    rows_q, rows_b = _cell_rows(qcell, a[full], b[full])
+    _union(parent, idx[rows_q], first[rows_b])
+
+    rows_q, rows_b = _cell_rows(qcell, a[~full], b[~full])
+    def edges(rows):
+        q, p = _row_pairs(fine, rows_q[rows], rows_b[rows], qxy, radius)
+        return idx[q], cores[p]
+    for e in _map(pool, edges, _chunks(np.arange(len(rows_q)), chunk_size, size[rows_b])):
+        _union(parent, *e)
+
+
+def core_roots(parent, is_core):
+    """Root of every core point, -1 elsewhere.
+
+    A root is the smallest index in its set, so ordering clusters by root is
+    the order in which sklearn's DBSCAN discovers (and numbers) them.
+    """
+    roots = np.full(len(is_core), -1, dtype=np.int64)
+    core_idx = np.flatnonzero(is_core)
+    roots[core_idx] = _find(parent, core_idx)
+    return roots
+
+
+def rank_roots(roots):
+    """Turn roots (-1 = noise) into consecutive labels 0..k-1 in root order."""
+    labels = np.full(len(roots), -1, dtype=np.int64)
+    member = roots >= 0
+    _, inv = np.unique(roots[member], return_inverse=True)
+    labels[member] = inv
+    return labels
+
+
+def label_cores(parent, is_core):
+    """Number core-point sets 0..k-1 in order of their first point, like sklearn."""
+    return rank_roots(core_roots(parent, is_core))
+
+
+def label_borders(index, labels, is_core, idx, radius, chunk_size=CHUNK_SIZE, pool=None):
+    """Give each non-core point in idx the smallest label among its core neighbors.
+
+    Works the same on roots (see core_roots) as on ranked labels.
+    """
+    def border(chunk):
+        q, p = index.pairs(index.xy[chunk], radius)
+        keep = is_core[p]
+        best = np.full(len(chunk), np.iinfo(np.int64).max)
+        np.minimum.at(best, q[keep], labels[p[keep]])
+        hit = best != np.iinfo(np.int64).max
+        return chunk[hit], best[hit]
+    for pts, lab in _map(pool, border, index.chunks(idx, chunk_size)):
+        labels[pts] = lab
+
+
+def dbscan_labels(xy, eps=EPS_FT, min_samples=MIN_SAMPLES, chunk_size=CHUNK_SIZE, n_jobs=None):
+    """DBSCAN cluster labels for an (n, 2) array of projected points.
+
+    Returns the same labels as sklearn.cluster.DBSCAN(eps, min_samples).fit(xy).labels_,
+    -1 marking noise. n_jobs threads run the neighbor queries (default: all cores).
+    """
+    with metrics.timer("dbscan"), ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        index = GridIndex(xy, eps)
+        n = len(index.xy)
+        is_core = np.zeros(n, dtype=bool)
+        is_core[index.order] = neighbor_counts(index, index.order, eps, chunk_size, pool) >= min_samples
+        parent = np.arange(n)
+        join_cores(index, parent, is_core, index.cell_order(is_core), eps, chunk_size, pool)
+        labels = label_cores(parent, is_core)
+        label_borders(index, labels, is_core, index.cell_order(~is_core), eps, chunk_size, pool)
+    metrics.count("dbscan_points", n)
+    return labels
+
+
+def cached_labels(csv_path=CSV_PATH, eps=EPS_FT, min_samples=MIN_SAMPLES, dbscan=None,
+                  cache_dir=CACHE_DIR) -> np.ndarray:
+    """DBSCAN labels of the cached complaints, in cache row order, computed once per export.
+
+    They are saved as labels-eps<eps>-min<min_samples>.npy in the export's cache folder.
+    dbscan computes them on a miss (default dbscan_labels; dbscan_sharded gives the same).
+    """
+    folder = build_cache(csv_path, cache_dir)
+    path = folder / f"labels-eps{eps:g}-min{min_samples}.npy"
+    if path.exists():
+        metrics.count("labels_cache", result="hit")
+        return np.load(path)
+
+    metrics.count("labels_cache", result="miss")
+    pts = load_columns(folder, columns=("x", "y"))
+    labels = (dbscan or dbscan_labels)(np.column_stack([pts["x"], pts["y"]]),
+                                       eps=eps, min_samples=min_samples)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}")
+    with open(tmp, "wb") as f:
+        np.save(f, labels)
+    os.replace(tmp, path)
+    return labels
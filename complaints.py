@@ -0,0 +1,199 @@
+# -----------------------------------------------------------
+# 0.  Load 311 complaints through a columnar on-disk cache
+# -----------------------------------------------------------
+# The 311 export has 41 columns, but the analysis scripts only need the unique key,
+# the created date, the borough, the status and the coordinates. The first time a CSV
+# is seen, only those columns are parsed, rows without coordinates are dropped and the
+# points are projected to NY State Plane (EPSG:2263, feet). Each column is then written
+# as a .npy file under data/cache/<sha256 of the CSV>-v<CACHE_VERSION>/, so later runs
+# memory-map the columns they need and skip both parsing and reprojection. Hashing a
+# multi-GB export is itself a full read, so the digest is remembered by path, size and
+# mtime, in the process and in data/cache/digests.json for the next scripts.
+#
+# Rows keep the CSV's order (newest first), so DBSCAN numbers clusters like the original
+# sklearn run. Cluster ids depend on that order and are not stable across exports: a new
+# complaint can turn noise into a cluster that is numbered ahead of existing ones, and
+# merged clusters are renumbered.
+#
+# The columns are plain arrays: int64 keys, epoch seconds, coordinates in both CRSs and
+# int8 codes for borough and status, about 50 bytes per complaint. Scripts read lat/lon
+# for maps and x/y for geometry instead of reprojecting a GeoDataFrame, and build
+# shapely objects only for the geometry operations that need them (see hot_areas.py).
+
+from pathlib import Path
+import hashlib, json, os, shutil, tempfile, threading
+
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+
+import metrics
+
+CSV_PATH  = "311_Service_Requests_from_2010_to_Present_20250621.csv"
+CACHE_DIR = Path("data/cache")
+DIGESTS   = "digests.json"                 # digests of exports seen, under CACHE_DIR
+CACHE_VERSION = 4                              # bump when the cached columns or row order change
+
+CREATED_FORMAT = "%m/%d/%Y %I:%M:%S %p"        # 06/19/2025 09:49:37 PM
+
+# cached column -> dtype; x/y are NY State Plane feet, created is UTC-naive seconds
+COLUMNS = {
+    "unique_key": np.int64,
+    "created":    "datetime64[s]",
+    "lat":        np.float64,
+    "lon":        np.float64,
+    "x":          np.float64,
+    "y":          np.float64,
+    "borough":    np.int8,                     # codes into <column>_labels.npy, -1 if missing
+    "status":     np.int8,
+}
+CATEGORIES = ("borough", "status")
+
+# CSV column -> dtype read from the export
+CSV_COLUMNS = {
+    "Unique Key":   "int64",
+    "Created Date": "string",
+    "Latitude":     "float64",
+    "Longitude":    "float64",
+    "Borough":      "category",
+    "Status":       "category",
+}
+
+
+_digests = {}                               # (resolved path, size, mtime_ns) -> sha256
+_digests_lock = threading.Lock()
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return str(Path(path).resolve()), st.st_size, st.st_mtime_ns
+
+
+def file_digest(path, block_size=1 << 20) -> str:
+    """SHA-256 of a file, read in 1 MiB blocks once per process while it is unchanged."""
+    key = _file_key(path)
+    with _digests_lock:
+        if key in _digests:
+            return _digests[key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    with _digests_lock:
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def cached_digest(path, cache_dir=CACHE_DIR) -> str:
+    """file_digest, remembered across processes in cache_dir/digests.json by path,
+    size and mtime, so an unchanged export is not read again to find its cache."""
+    name, size, mtime_ns = _file_key(path)
+    sidecar = Path(cache_dir) / DIGESTS
+    try:
+        known = json.loads(sidecar.read_text())
+    except (OSError, ValueError):
+        known = {}
+    entry = known.get(name)
+    if entry and entry["size"] == size and entry["mtime_ns"] == mtime_ns:
+        return entry["sha256"]
+
+    digest = file_digest(path)
+    known[name] = {"size": size, "mtime_ns": mtime_ns, "sha256": digest}
+    sidecar.parent.mkdir(parents=True, exist_ok=True)
+    tmp = sidecar.with_name(f".{sidecar.name}.{os.getpid()}.{threading.get_ident()}")
+    tmp.write_text(json.dumps(known, indent=2))
+    os.replace(tmp, sidecar)
+    return digest
+
+
+def _parse_csv(csv_path) -> dict:
+    """Parse only the needed CSV columns and project the points to EPSG:2263."""
+    with metrics.timer("csv_load"):
+        df = pd.read_csv(csv_path, usecols=list(CSV_COLUMNS), dtype=CSV_COLUMNS)
+
+        # Clean the data by removing rows with missing coordinates
+        df = df.dropna(subset=["Longitude", "Latitude"])
+    metrics.count("csv_rows", len(df))
+
+    lon = df["Longitude"].to_numpy(np.float64)
+    lat = df["Latitude"].to_numpy(np.float64)
+    with metrics.timer("reproject"):
+        to_ft = Transformer.from_crs("EPSG:4326", "EPSG:2263", always_xy=True)
+        x, y = to_ft.transform(lon, lat)          # NY-Long Island ft
+
+    created = pd.to_datetime(df["Created Date"], format=CREATED_FORMAT)
+    borough, status = df["Borough"].cat, df["Status"].cat
+    return {
+        "unique_key": df["Unique Key"].to_numpy(np.int64),
+        "created":    created.to_numpy().astype("datetime64[s]"),
+        "lat":        lat,
+        "lon":        lon,
+        "x":          np.asarray(x, dtype=np.float64),
+        "y":          np.asarray(y, dtype=np.float64),
+        "borough":    borough.codes.to_numpy(),
+        "status":     status.codes.to_numpy(),
+        "borough_labels": borough.categories.to_numpy(str),
+        "status_labels":  status.categories.to_numpy(str),
+    }
+
+
+def build_cache(csv_path=CSV_PATH, cache_dir=CACHE_DIR) -> Path:
+    """Convert the CSV into per-column .npy files; return the cache folder.
+
+    The folder is keyed by the CSV's content hash (see cached_digest) and is
+    written through a temporary folder, so an interrupted build never leaves a
+    partial cache.
+    """
+    cache_dir = Path(cache_dir)
+    target = cache_dir / f"{cached_digest(csv_path, cache_dir)}-v{CACHE_VERSION}"
+    if target.exists():
+        metrics.count("complaints_cache", result="hit")
+        return target
+
+    metrics.count("complaints_cache", result="miss")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=cache_dir, prefix=".build-"))
+    try:
+        for name, values in _parse_csv(csv_path).items():
+            np.save(tmp / f"{name}.npy", values.astype(COLUMNS.get(name, values.dtype), copy=False))
+        os.replace(tmp, target)
+    except OSError:
+        # another process finished the same cache first
+        if not target.exists():
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return target
+
+
+def load_columns(folder, columns=tuple(COLUMNS)) -> dict:
+    """Return {column: read-only memory-mapped array} from a folder build_cache returned.
+
+    Borough and status come back as pandas Categoricals over the cached int8 codes.
+    """
+    unknown = set(columns) - set(COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown complaint columns: {sorted(unknown)}")
+
+    folder = Path(folder)
+    out = {name: np.load(folder / f"{name}.npy", mmap_mode="r") for name in columns}
+    for name in CATEGORIES:
+        if name in out:
+            labels = np.load(folder / f"{name}_labels.npy")
+            out[name] = pd.Categorical.from_codes(out[name], labels, validate=False)
+    return out
+
+
+def load_complaints(csv_path=CSV_PATH, columns=tuple(COLUMNS), cache_dir=CACHE_DIR) -> dict:
+    """Return {column: read-only memory-mapped array} for the requested columns.
+
+    Borough and status come back as pandas Categoricals over the cached int8 codes.
+    """
+    with metrics.timer("complaints_load"):
+        return load_columns(build_cache(csv_path, cache_dir), columns)
+
+
+def to_latlon(x, y):
+    """(lat, lon) arrays of State Plane points; for points not read from the cache."""
+    lon, lat = Transformer.from_crs("EPSG:2263", "EPSG:4326", always_xy=True).transform(x, y)
+    return np.asarray(lat), np.asarray(lon)
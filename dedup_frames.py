@@ -0,0 +1,95 @@
+# -----------------------------------------------------------
+# Near-duplicate frame suppression before inference
+# -----------------------------------------------------------
+# A Mapillary sequence through a hot block has dozens of frames taken a meter apart,
+# and all of them look the same to the trash-bag detector. Frames are grouped by
+# viewpoint and time: a VIEWPOINT_M grid cell of the saved lat/lon, a COMPASS_DEG
+# heading sector and a TIME_BUCKET_DAYS window of capturedAt. Within a group, a 64-bit
+# difference hash (dHash) of each image drops frames within HAMMING_MAX bits of a frame
+# already kept. Newest frames are kept first, so each viewpoint is scored on its latest view.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import json, math
+
+import numpy as np
+from PIL import Image
+
+VIEWPOINT_M      = 5                   # position grid, meters
+COMPASS_DEG      = 45                  # heading sectors
+TIME_BUCKET_DAYS = 1
+HAMMING_MAX      = 10                  # dHash bits that may differ for a duplicate
+HASH_WORKERS     = 4
+
+_M_PER_DEG_LAT = 110_540
+_M_PER_DEG_LON = 111_320               # at the equator; scaled by cos(lat)
+
+
+def dhash(path, size=8) -> int | None:
+    """64-bit difference hash: brightness gradients of a 9x8 grayscale thumbnail.
+
+    None if the image cannot be decoded; scoring reports the error for that frame.
+    """
+    try:
+        img = Image.open(path)
+        img.draft("L", (size * 8, size * 8))    # decode at reduced size, it's all thrown away
+        px = np.asarray(img.convert("L").resize((size + 1, size), Image.LANCZOS), dtype=np.int16)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    bits = (px[:, 1:] > px[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def read_meta(jpg: Path) -> dict:
+    """Metadata download.py saved next to the image, or {} if there is none."""
+    meta_path = jpg.with_suffix(".json")
+    if not meta_path.exists():
+        return {}
+    return json.loads(meta_path.read_text())
+
+
+def viewpoint(meta: dict):
+    """(x cell, y cell, heading sector, time bucket) of a frame, or None if unknown."""
+    lat, lon = meta.get("lat"), meta.get("lon")
+    if lat is None or lon is None:
+        return None
+    x = lon * _M_PER_DEG_LON * math.cos(math.radians(lat))
+    y = lat * _M_PER_DEG_LAT
+    compass = meta.get("compass")
+    sector = int(compass // COMPASS_DEG) % (360 // COMPASS_DEG) if compass is not None else -1
+    captured = meta.get("capturedAt")
+    day = int(captured // (TIME_BUCKET_DAYS * 86_400_000)) if captured is not None else -1
+    return (int(x // VIEWPOINT_M), int(y // VIEWPOINT_M), sector, day)
+
+
+def select_frames(images, workers=HASH_WORKERS):
+    """Split (cluster, image id, path) tuples into representatives and duplicates.
+
+    Returns (kept, duplicates) where duplicates maps each dropped
+    (cluster, image id) to the (cluster, image id) that stands in for it.
+    Frames are grouped per cluster, so every cluster keeps its own coverage. Frames that
+    cannot be decoded are kept on their own and fail when scored.
+    """
+    images = list(images)
+    metas = [read_meta(path) for _, _, path in images]
+    with ThreadPoolExecutor(workers) as pool:
+        hashes = list(pool.map(lambda img: dhash(img[2]), images))
+
+    groups = {}
+    for i, (cluster, image_id, _) in enumerate(images):
+        vp = viewpoint(metas[i]) if hashes[i] is not None else None
+        groups.setdefault((cluster, vp if vp is not None else ("image", image_id)), []).append(i)
+
+    kept, duplicates = [], {}
+    for members in groups.values():
+        members.sort(key=lambda i: metas[i].get("capturedAt") or 0, reverse=True)
+        reps = []
+        for i in members:
+            near = next((r for r in reps if (hashes[i] ^ hashes[r]).bit_count() <= HAMMING_MAX), None)
+            if near is None:
+                reps.append(i)
+            else:
+                duplicates[images[i][:2]] = images[near][:2]
+        kept.extend(reps)
+    kept.sort()
+    return [images[i] for i in kept], duplicates
@@ -2,185 +2,207 @@
 # 2.  Download images + metadata via Mapillary API v4
 # -----------------------------------------------------------
 # This script downloads images and metadata from Mapillary's API v4 for specific geographic areas.
-# It focuses on 3 key clusters identified in a previous clustering analysis.
+# It downloads the hot clusters that find_top_clusters.py publishes in data/hot_bboxes.jsonl,
+# starting on each cluster as soon as it appears (see hot_bboxes.py). Started together
+# with find_top_clusters.py, pass --wait-new-run so the previous, finished run is skipped.
 # For each cluster's bounding box coordinates, it queries the Mapillary API to retrieve
 # street-level imagery and associated metadata (location, compass angle, capture time etc).
 # The data is saved to data/raw/ with images organized by cluster.
 # Requires a Mapillary API token set as MAPILLARY_TOKEN environment variable.
+# Images are fetched by a thread pool over one pooled, rate-limited session
+# (see mapillary_client.py); set MAPILLARY_API_URL to use a local stand-in.
+# Each image is stored once in data/images/ (see image_store.py) and hard-linked
+# into every cluster folder that references it; interrupted downloads resume.
+# Per-image progress is logged at DEBUG (LOG_LEVEL=DEBUG, see metrics.py).
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from tqdm.auto import tqdm
-import os, json, requests, time
+import os, json, logging, requests, sys
 
-MAP_TOKEN = os.getenv("MAPILLARY_TOKEN")              # export MAPILLARY_TOKEN="xxxx"
-if not MAP_TOKEN:
-    raise ValueError("MAPILLARY_TOKEN environment variable not set")
+import metrics
+from hot_bboxes import read_hot_bboxes
+from image_store import ImageStore, write_atomic
+from mapillary_client import MapillaryClient
 
 OUT_DIR   = Path("data/raw")
-OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 # Test mode: limit to 3 images per cluster for testing
 TEST_MODE = False
 TEST_IMAGES_PER_CLUSTER = 3
 
-# Top 3 clusters from clustering analysis (output from find_top_clusters.py)
-hot_bboxes = [
-    {
-        "west": -74.003774,
-        "south": 40.732110,
-        "east": -74.003323,
-        "north": 40.732472,
-        "cid": 3
-    },
-    {
-        "west": -74.001418,
-        "south": 40.736482,
-        "east": -74.000942,
-        "north": 40.736883,
-        "cid": 28
-    },
-    {
-        "west": -73.996165,
-        "south": 40.719973,
-        "east": -73.995732,
-        "north": 40.720302,
-        "cid": 1
-    }
-]
-
-def get_images_in_bbox(bbox, access_token):
-    """Get images in bounding box using Mapillary API v4"""
-    # API endpoint for images
-    url = "https://graph.mapillary.com/images"
-    
-    # Query parameters
-    params = {
-        'access_token': access_token,
-        'bbox': f"{bbox['west']},{bbox['south']},{bbox['east']},{bbox['north']}",
-        'limit': 1000  # Maximum limit
-    }
-    
-    headers = {
-        'Authorization': f'OAuth {access_token}'
-    }
-    
+# Images fetched at once; API calls are still spaced by the client's token bucket
+MAX_WORKERS = 8
+
+# Fields requested in the bbox search itself, so no per-image detail call is needed
+IMAGE_FIELDS = ['id', 'captured_at', 'compass_angle', 'geometry',
+                'thumb_2048_url', 'thumb_1024_url', 'thumb_original_url']
+
+# Hot bboxes are streamed from find_top_clusters.py through data/hot_bboxes.jsonl.
+# Keep waiting for the next cluster for up to this many seconds.
+FOLLOW_TIMEOUT_SEC = 600
+
+log = logging.getLogger(__name__)
+
+def get_images_in_bbox(bbox, client):
+    """Get images in bounding box, with their details, using Mapillary API v4.
+
+    Dense bboxes are split into tiles so the 1000-image search cap never drops results.
+    Returns None if the search failed.
+    """
     try:
-        response = requests.get(url, params=params, headers=headers)
-        response.raise_for_status()
-        return response.json()['data']
+        return client.search_images(bbox, IMAGE_FIELDS)
     except requests.exceptions.RequestException as e:
-        print(f"API request failed: {e}")
-        return []
+        log.error(f"API request failed: {e}")
+        return None
 
-def get_image_details(image_id, access_token):
+def get_image_details(image_id, client):
     """Get detailed image information including download URLs"""
-    url = f"https://graph.mapillary.com/{image_id}"
-    
     params = {
-        'access_token': access_token,
-        'fields': 'id,captured_at,compass_angle,geometry,thumb_2048_url,thumb_1024_url,thumb_original_url'
+        'fields': ','.join(IMAGE_FIELDS)
     }
-    
-    headers = {
-        'Authorization': f'OAuth {access_token}'
-    }
-    
+
     try:
-        response = requests.get(url, params=params, headers=headers)
-        response.raise_for_status()
-        return response.json()
+        return client.get_json(image_id, params)
     except requests.exceptions.RequestException as e:
-        print(f"Failed to get details for {image_id}: {e}")
+        log.warning(f"Failed to get details for {image_id}: {e}")
         return None
 
-def save_image(img_id: str, url_2048: str, meta: dict, out_folder: Path):
-    """Stream image to disk and write metadata JSON."""
+def save_image(img_id: str, url_2048: str, meta: dict, out_folder: Path, client, store):
+    """Fetch image into the shared store (once), link it into the cluster folder, write metadata JSON."""
     jpg_path  = out_folder / f"{img_id}.jpg"
     json_path = out_folder / f"{img_id}.json"
-    if jpg_path.exists():         # skip if downloaded before
-        return
-    
-    # Add authorization header for image download
-    headers = {
-        'Authorization': f'OAuth {MAP_TOKEN}'
+
+    stored = store.fetch(img_id, url_2048, client, meta)
+    store.add_cluster(img_id, meta["cluster"])
+    store.link(stored, jpg_path)
+    if not json_path.exists():
+        write_atomic(json_path, json.dumps(meta, indent=2))
+
+def image_meta(img, cid, client):
+    """Metadata saved with an image found by the bbox search, or None without a usable URL."""
+    img_id = img["id"]
+    image_details = img
+    if not any(f in img for f in ('thumb_2048_url', 'thumb_1024_url', 'thumb_original_url')):
+        # search result came back without URLs: fall back to a detail call
+        log.debug(f"Getting details for image {img_id}...")
+        image_details = get_image_details(img_id, client)
+
+    if not image_details:
+        log.warning(f" ! Failed to get details for {img_id}")
+        return None
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"Image details: {json.dumps(image_details, indent=2)}")
+
+    # Try to get the best available image URL
+    image_url = None
+    if 'thumb_2048_url' in image_details:
+        image_url = image_details['thumb_2048_url']
+    elif 'thumb_1024_url' in image_details:
+        image_url = image_details['thumb_1024_url']
+    elif 'thumb_original_url' in image_details:
+        image_url = image_details['thumb_original_url']
+
+    if not image_url:
+        log.warning(f" ! No image URL found for {img_id}")
+        return None
+
+    return {
+        "id": img_id,
+        "capturedAt": image_details.get("captured_at"),
+        "compass": image_details.get("compass_angle"),
+        "lat": image_details.get("geometry", {}).get("coordinates", [0, 0])[1],
+        "lon": image_details.get("geometry", {}).get("coordinates", [0, 0])[0],
+        "cluster": cid,
+        "image_url": image_url,
+        "full_response": image_details
     }
-    
-    with requests.get(url_2048, stream=True, headers=headers) as r:
-        r.raise_for_status()
-        with open(jpg_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=16384):
-                f.write(chunk)
-    json_path.write_text(json.dumps(meta, indent=2))
-
-for bb in hot_bboxes:
-    cid = bb.pop("cid")                           # remove cid key for API call
-    print(f"\n⬇︎ Downloading cluster {cid}")
-    
+
+def fetch_image(img, cid, block_dir, client, store):
+    """Download one image found by the bbox search; runs on a worker thread.
+
+    Returns whether the image was saved.
+    """
+    img_id = img["id"]
+    meta = image_meta(img, cid, client)
+    if meta is None:
+        return False
+
     try:
-        # Get images using direct API call
-        images = get_images_in_bbox(bb, MAP_TOKEN)
-        block_dir = OUT_DIR / f"cluster_{cid}"
-        block_dir.mkdir(exist_ok=True)
-
-        total_images = len(images)
-        print(f"Found {total_images} images in cluster {cid}")
-        
-        # Limit images for testing
-        if TEST_MODE:
-            images_to_download = images[:TEST_IMAGES_PER_CLUSTER]
-            print(f"TEST MODE: Downloading only {len(images_to_download)} images (limited from {total_images})")
-        else:
-            images_to_download = images
-            print(f"Downloading all {total_images} images")
-
-        for img in tqdm(images_to_download, desc=f"cluster {cid}", unit="img"):
-            img_id = img["id"]
-            
-            # Get detailed image information including download URLs
-            print(f"\nGetting details for image {img_id}...")
-            image_details = get_image_details(img_id, MAP_TOKEN)
-            
-            if image_details:
-                print(f"Image details: {json.dumps(image_details, indent=2)}")
-                
-                # Try to get the best available image URL
-                image_url = None
-                if 'thumb_2048_url' in image_details:
-                    image_url = image_details['thumb_2048_url']
-                elif 'thumb_1024_url' in image_details:
-                    image_url = image_details['thumb_1024_url']
-                elif 'thumb_original_url' in image_details:
-                    image_url = image_details['thumb_original_url']
-                
-                if image_url:
-                    meta = {
-                        "id": img_id,
-                        "capturedAt": image_details.get("captured_at"),
-                        "compass": image_details.get("compass_angle"),
-                        "lat": image_details.get("geometry", {}).get("coordinates", [0, 0])[1],
-                        "lon": image_details.get("geometry", {}).get("coordinates", [0, 0])[0],
-                        "cluster": cid,
-                        "image_url": image_url,
-                        "full_response": image_details
-                    }
-                    
-                    try:
-                        save_image(img_id, image_url, meta, block_dir)
-                        print(f" ✓ Downloaded {img_id}")
-                    except Exception as e:
-                        print(f" ! Error downloading {img_id}: {e}")
-                else:
-                    print(f" ! No image URL found for {img_id}")
-            else:
-                print(f" ! Failed to get details for {img_id}")
-            
-            time.sleep(0.5)  # Rate limiting
-                
+        save_image(img_id, meta["image_url"], meta, block_dir, client, store)
+        log.debug(f" ✓ Downloaded {img_id}")
+        metrics.count("images_saved")
+        return True
     except Exception as e:
-        print(f"Error processing cluster {cid}: {e}")
-        continue
+        log.warning(f" ! Error downloading {img_id}: {e}")
+        metrics.count("image_failures")
+        return False
+
+def get_token():
+    token = os.getenv("MAPILLARY_TOKEN")              # export MAPILLARY_TOKEN="xxxx"
+    if not token:
+        raise ValueError("MAPILLARY_TOKEN environment variable not set")
+    return token
+
+def search_cluster(bb, client):
+    """Images the bbox search finds for one hot bbox (the first few in TEST_MODE)."""
+    cid = bb["cid"]
+
+    # Get images using direct API call
+    images = get_images_in_bbox(bb, client)
+    if images is None:
+        raise RuntimeError("image search failed")
+
+    total_images = len(images)
+    print(f"Found {total_images} images in cluster {cid}")
+
+    # Limit images for testing
+    if TEST_MODE:
+        images_to_download = images[:TEST_IMAGES_PER_CLUSTER]
+        print(f"TEST MODE: Downloading only {len(images_to_download)} images (limited from {total_images})")
+    else:
+        images_to_download = images
+        print(f"Downloading all {total_images} images")
+    return images_to_download
+
+def download_cluster(bb, client, store, pool, images=None):
+    """Download one hot bbox's images on the shared pool, searching for them unless given.
+
+    Returns the ids of the images saved into the cluster folder and the number
+    of images that could not be saved.
+    """
+    cid = bb["cid"]
+    print(f"\n⬇︎ Downloading cluster {cid}")
+    images_to_download = search_cluster(bb, client) if images is None else images
+    block_dir = OUT_DIR / f"cluster_{cid}"
+    block_dir.mkdir(parents=True, exist_ok=True)
+
+    futures = {pool.submit(fetch_image, img, cid, block_dir, client, store): str(img["id"])
+               for img in images_to_download}
+    saved, failed = [], 0
+    for future in tqdm(as_completed(futures), total=len(futures),
+                       desc=f"cluster {cid}", unit="img"):
+        if future.result():
+            saved.append(futures[future])
+        else:
+            failed += 1
+    return sorted(saved), failed
+
+def main(wait_new_run=False):
+    """Download every hot bbox of the current run, or with wait_new_run of the next one."""
+    with MapillaryClient(get_token()) as client, ImageStore() as store, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for bb in read_hot_bboxes(follow=True, timeout=FOLLOW_TIMEOUT_SEC, new_run=wait_new_run):
+            try:
+                download_cluster(bb, client, store, pool)
+            except Exception as e:
+                log.error(f"Error processing cluster {bb['cid']}: {e}")
+
+    print("✅  Download complete")
+    if TEST_MODE:
+        print(f"🧪 TEST MODE: Limited to {TEST_IMAGES_PER_CLUSTER} images per cluster")
+        print("To download all images, set TEST_MODE = False")
 
-print("✅  Download complete")
-if TEST_MODE:
-    print(f"🧪 TEST MODE: Limited to {TEST_IMAGES_PER_CLUSTER} images per cluster")
-    print("To download all images, set TEST_MODE = False")
+if __name__ == "__main__":
+    metrics.run(main, "--wait-new-run" in sys.argv[1:])
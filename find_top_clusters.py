@@ -4,145 +4,207 @@
 # This script processes NYC 311 service request data to identify hotspots of sidewalk blockages.
 # It loads clustered complaint data, selects the top N most concentrated areas, and calculates
 # bounding boxes around them for further analysis. The bounding boxes are used to fetch street-level
-# imagery of these problematic locations.
-import pandas as pd, geopandas as gpd
-from shapely.geometry import Point, box
-from sklearn.cluster import DBSCAN
+# imagery of these problematic locations: each one is written to data/hot_bboxes.jsonl as soon as
+# it is computed, and download.py follows that file (see hot_bboxes.py).
+import pandas as pd
+from pyproj import Transformer
 import folium
+import numpy as np
+import metrics
+from complaints import load_complaints
+from clustering import cached_labels, dbscan_labels
+from sharded_clustering import dbscan_sharded
+from hot_areas import cluster_envelopes
+from incremental_clusters import refresh_clusters, window_labels
+from map_layers import add_heatmap, add_points, cluster_sizes
+from cell_bins import refresh_grids
+from hot_bboxes import HotBBoxWriter
 
 CLUSTERS_CSV = "311_Service_Requests_from_2010_to_Present_20250621.csv"
 TOP_N = 3                              # download imagery for the 3 busiest blocks
 BUFFER_FT = 60                         # meters: enlarge each block bbox a tiny bit
 
-df = pd.read_csv(CLUSTERS_CSV)
-
-# Clean the data by removing rows with missing coordinates
-df = df.dropna(subset=['Longitude', 'Latitude'])
-
-gdf = gpd.GeoDataFrame(
-        df, geometry=gpd.points_from_xy(df.Longitude, df.Latitude),
-        crs="EPSG:4326").to_crs(2263)   # NY State Plane (ft)
-
-# Perform DBSCAN clustering
-coords = gdf.geometry.apply(lambda p: [p.x, p.y]).tolist()
-db = DBSCAN(eps=30, min_samples=5).fit(coords)  # 30 ft = ~9 m
-gdf["cluster"] = db.labels_
-
-# group by cluster id, descending size
-top_clusters = (gdf[gdf.cluster!=-1]
-                .groupby("cluster")
-                .size()
-                .sort_values(ascending=False)
-                .head(TOP_N)
-                .index)
-
-hot_bboxes = []
-for cid in top_clusters:
-    geom = gdf[gdf.cluster==cid].geometry
-    env  = geom.unary_union.envelope.buffer(BUFFER_FT)  # add margin
-    minx, miny, maxx, maxy = env.bounds
-    # re-project back to lat/lon for Mapillary
-    env_latlon = gpd.GeoSeries(box(minx, miny, maxx, maxy), crs=2263).to_crs(4326)[0]
-    w, s, e, n = env_latlon.bounds
-    hot_bboxes.append(dict(west=w, south=s, east=e, north=n, cid=int(cid)))
-
-print(f"Selected {len(hot_bboxes)} hot blocks:")
-for bb in hot_bboxes:
-    print(f"  cluster {bb['cid']:>3}: ({bb['south']:.6f},{bb['west']:.6f}) – "
-          f"({bb['north']:.6f},{bb['east']:.6f})")
-
-# Print cluster statistics
-print(f"\nCluster Statistics:")
-print(f"Total points: {len(gdf)}")
-print(f"Points in clusters: {len(gdf[gdf.cluster != -1])}")
-print(f"Noise points: {len(gdf[gdf.cluster == -1])}")
-print(f"Number of clusters: {len(gdf[gdf.cluster != -1]['cluster'].unique())}")
-
-# Visualization: Create interactive map of top 3 clusters
-# Convert back to WGS84 for mapping
-gdf_wgs84 = gdf.to_crs("EPSG:4326")
-
-# Calculate center point for the map
-center_lat = gdf_wgs84.geometry.y.mean()
-center_lon = gdf_wgs84.geometry.x.mean()
-
-# Create the map
-m = folium.Map(location=[center_lat, center_lon], zoom_start=12)
-
-# Define colors for top clusters
-top_colors = ['red', 'blue', 'green']
-
-# Add bounding boxes for top clusters
-for i, bb in enumerate(hot_bboxes):
-    color = top_colors[i] if i < len(top_colors) else 'purple'
+# Incremental mode: keep the clustering in data/cluster_state/ and only fold in
+# complaints it has not clustered yet (see incremental_clusters.py)
+INCREMENTAL = False
+
+# Cluster spatial tiles in a process pool, or on several machines when CLUSTER_QUEUE
+# is set; same labels as the single-process run (see sharded_clustering.py)
+SHARDED = False
+
+# Spatio-temporal mode: also rank hotspots within the last N days of complaints,
+# e.g. (7, 30, 90). All windows are computed in one pass (see window_labels).
+TIME_WINDOWS = None
+
+# Cell counts answer "where are complaints densest" without clustering; they are kept
+# in data/cell_counts/ and only new complaints are binned (see cell_bins.py)
+RANK_GRID    = "square_100"            # grid ranked next to the clusters
+HEATMAP_GRID = "hex_150"               # grid drawn as the heatmap layer
+
+MAP_HTML = "top3_clusters_map.html"
+
+
+def latlon_bbox(minx, miny, maxx, maxy):
+    """Re-project a State Plane bbox back to a lat/lon dict for Mapillary."""
+    # bounds of the reprojected corners, as for the reprojected box polygon
+    transformer = Transformer.from_crs("EPSG:2263", "EPSG:4326", always_xy=True)
+    lon, lat = transformer.transform([minx, maxx, maxx, minx], [miny, miny, maxy, maxy])
+    return dict(west=min(lon), south=min(lat), east=max(lon), north=max(lat))
+
+
+def main():
+    """Publish the TOP_N hot blocks to data/hot_bboxes.jsonl and map them."""
+    # Start a new hand-off file right away so a waiting download.py ignores the previous run.
+    # It ends with a done line as soon as the last hot block is written, before the map is
+    # built, or with an error line if picking the blocks fails
+    with HotBBoxWriter() as hot_out:
+        # Cached complaint coordinates in both CRSs (see complaints.py)
+        pts = load_complaints(CLUSTERS_CSV, columns=("unique_key", "lat", "lon", "x", "y"))
+        coords = np.column_stack([pts["x"], pts["y"]])   # NY State Plane (ft)
+        lat, lon = pts["lat"], pts["lon"]
+
+        if INCREMENTAL:
+            state = refresh_clusters(CLUSTERS_CSV, eps=30, min_samples=5)
+            labels = state.labels(pts["unique_key"])     # numbered like the full run
+        else:
+            # Perform DBSCAN clustering, once per export for all the maps
+            dbscan = dbscan_sharded if SHARDED else dbscan_labels
+            labels = cached_labels(CLUSTERS_CSV, eps=30, min_samples=5, dbscan=dbscan)  # 30 ft = ~9 m
+
+        # group by cluster id, descending size
+        clusters = pd.DataFrame({"cluster": labels})
+        top_clusters = (clusters[clusters.cluster != -1]
+                        .groupby("cluster")
+                        .size()
+                        .sort_values(ascending=False)
+                        .head(TOP_N)
+                        .index)
+
+        # every cluster's bounds plus margin, straight from the coordinates (see hot_areas.py)
+        ids, sizes, bounds = cluster_envelopes(coords, labels, BUFFER_FT)
+
+        hot_bboxes = []
+        for cid in top_clusters:
+            i = np.searchsorted(ids, cid)
+            # re-project back to lat/lon for Mapillary
+            bb = dict(**latlon_bbox(*bounds[i]), cid=int(cid), size=int(sizes[i]))
+            hot_bboxes.append(bb)
+            hot_out.write(bb)                       # download.py can start on it now
+
+    print(f"Selected {len(hot_bboxes)} hot blocks:")
+    for bb in hot_bboxes:
+        print(f"  cluster {bb['cid']:>3}: ({bb['south']:.6f},{bb['west']:.6f}) – "
+              f"({bb['north']:.6f},{bb['east']:.6f})")
+
+    # Print cluster statistics
+    print(f"\nCluster Statistics:")
+    noise = labels == -1
+    print(f"Total points: {len(labels)}")
+    print(f"Points in clusters: {np.count_nonzero(~noise)}")
+    print(f"Noise points: {np.count_nonzero(noise)}")
+    print(f"Number of clusters: {len(np.unique(labels[~noise]))}")
+
+    # Busiest grid cells
+    grids = {g.name: g for g in refresh_grids(CLUSTERS_CSV)}
+    print(f"\nBusiest {RANK_GRID} cells:")
+    for c in grids[RANK_GRID].top(TOP_N):
+        print(f"  {c['count']:>4} complaints around ({c['lat']:.6f},{c['lon']:.6f})")
+
+    # Hotspots per rolling window: where trash is piling up now (printed only; the
+    # hand-off file keeps the full-history blocks, whose cids download.py uses as folders)
+    if TIME_WINDOWS:
+        recent = load_complaints(CLUSTERS_CSV, columns=("created", "x", "y"))
+        xy = np.column_stack([recent["x"], recent["y"]])
+        print(f"\nHotspots ending {recent['created'].max()}:")
+        for days, w_rows, w_labels in window_labels(recent["created"], xy, TIME_WINDOWS,
+                                                    eps=30, min_samples=5):
+            w_sizes = np.bincount(w_labels[w_labels != -1])
+            print(f"  last {days:>3} days: {len(w_rows)} complaints, {len(w_sizes)} clusters")
+            for cid in np.argsort(-w_sizes, kind="stable")[:TOP_N]:
+                members = xy[w_rows[w_labels == cid]]
+                bb = latlon_bbox(*(members.min(axis=0) - BUFFER_FT), *(members.max(axis=0) + BUFFER_FT))
+                print(f"    cluster {cid:>3} ({w_sizes[cid]} pts): ({bb['south']:.6f},{bb['west']:.6f}) – "
+                      f"({bb['north']:.6f},{bb['east']:.6f})")
+
+    # Visualization: Create interactive map of top 3 clusters
+    # Calculate center point for the map
+    center_lat = lat.mean()
+    center_lon = lon.mean()
+
+    # Create the map
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=12)
+
+    # Define colors for top clusters
+    top_colors = ['red', 'blue', 'green']
+
+    # Cluster sizes for the popups, computed once
+    sizes = cluster_sizes(labels)
+
+    # Add bounding boxes for top clusters
+    for i, bb in enumerate(hot_bboxes):
+        color = top_colors[i] if i < len(top_colors) else 'purple'
     
-    # Create bounding box polygon
-    bbox_coords = [
-        [bb['south'], bb['west']],
-        [bb['south'], bb['east']],
-        [bb['north'], bb['east']],
-        [bb['north'], bb['west']],
-        [bb['south'], bb['west']]
-    ]
+        # Create bounding box polygon
+        bbox_coords = [
+            [bb['south'], bb['west']],
+            [bb['south'], bb['east']],
+            [bb['north'], bb['east']],
+            [bb['north'], bb['west']],
+            [bb['south'], bb['west']]
+        ]
     
-    # Add bounding box to map
-    folium.Polygon(
-        locations=bbox_coords,
-        color=color,
-        weight=3,
-        fill=True,
-        fillColor=color,
-        fillOpacity=0.1,
-        popup=f'Cluster {bb["cid"]} Bounding Box<br>Size: {len(gdf_wgs84[gdf_wgs84.cluster == bb["cid"]])} points'
-    ).add_to(m)
-
-# Add points for top clusters
-for i, cid in enumerate(top_clusters):
-    color = top_colors[i] if i < len(top_colors) else 'purple'
-    cluster_points = gdf_wgs84[gdf_wgs84.cluster == cid]
-    
-    for idx, row in cluster_points.iterrows():
-        folium.CircleMarker(
-            location=[row.geometry.y, row.geometry.x],
-            radius=4,
+        # Add bounding box to map
+        folium.Polygon(
+            locations=bbox_coords,
             color=color,
+            weight=3,
             fill=True,
             fillColor=color,
-            fillOpacity=0.7,
-            popup=f'Cluster {cid}<br>Point {idx}'
+            fillOpacity=0.1,
+            popup=f'Cluster {bb["cid"]} Bounding Box<br>Size: {sizes[bb["cid"]]} points'
         ).add_to(m)
 
-# Add noise points (smaller and gray)
-noise_points = gdf_wgs84[gdf_wgs84.cluster == -1]
-for idx, row in noise_points.iterrows():
-    folium.CircleMarker(
-        location=[row.geometry.y, row.geometry.x],
-        radius=2,
-        color='gray',
-        fill=True,
-        fillColor='gray',
-        fillOpacity=0.3,
-        popup=f'Noise Point<br>Point {idx}'
-    ).add_to(m)
-
-# Add legend
-legend_html = '''
-<div style="position: fixed; 
-            bottom: 50px; left: 50px; width: 250px; height: 200px; 
-            background-color: white; border:2px solid grey; z-index:9999; 
-            font-size:14px; padding: 10px">
-            <p><b>Top 3 Clusters</b></p>
-            <p><i class="fa fa-square" style="color:red"></i> Cluster 0 (Largest)</p>
-            <p><i class="fa fa-square" style="color:blue"></i> Cluster 1 (2nd Largest)</p>
-            <p><i class="fa fa-square" style="color:green"></i> Cluster 2 (3rd Largest)</p>
-            <p><i class="fa fa-circle" style="color:gray"></i> Noise Points</p>
-            <p><b>Red/Blue/Green boxes:</b><br>
-            Bounding boxes with 60ft buffer</p>
-</div>
-'''
-m.get_root().html.add_child(folium.Element(legend_html))
-
-# Save the map
-m.save('top3_clusters_map.html')
-print("\nInteractive map saved as 'top3_clusters_map.html'")
-print("Open this file in your web browser to view the visualization")
+    # Add points for top clusters as one layer, colored by rank
+    top_points = np.isin(labels, top_clusters)
+    rank = {cid: i for i, cid in enumerate(top_clusters)}
+    add_points(m, lat[top_points], lon[top_points],
+               colors=[top_colors[i] if i < len(top_colors) else 'purple' for i in range(len(top_clusters))],
+               groups=clusters.cluster[top_points].map(rank),
+               popups=[f'Cluster {cid}<br>Size: {sizes[cid]} points' for cid in top_clusters],
+               radius=4, fill_opacity=0.7, name='Top clusters')
+
+    # Add the complaint heatmap from the cell counts
+    add_heatmap(m, *grids[HEATMAP_GRID].heat_points(), name='Complaint heatmap')
+
+    # Add noise points (smaller and gray)
+    add_points(m, lat[noise], lon[noise],
+               colors=['gray'], popups=['Noise Point'],
+               radius=2, fill_opacity=0.3, name='Noise points')
+
+    # Add legend
+    legend_html = '''
+    <div style="position: fixed; 
+                bottom: 50px; left: 50px; width: 250px; height: 200px; 
+                background-color: white; border:2px solid grey; z-index:9999; 
+                font-size:14px; padding: 10px">
+                <p><b>Top 3 Clusters</b></p>
+                <p><i class="fa fa-square" style="color:red"></i> Cluster 0 (Largest)</p>
+                <p><i class="fa fa-square" style="color:blue"></i> Cluster 1 (2nd Largest)</p>
+                <p><i class="fa fa-square" style="color:green"></i> Cluster 2 (3rd Largest)</p>
+                <p><i class="fa fa-circle" style="color:gray"></i> Noise Points</p>
+                <p><b>Red/Blue/Green boxes:</b><br>
+                Bounding boxes with 60ft buffer</p>
+    </div>
+    '''
+    m.get_root().html.add_child(folium.Element(legend_html))
+
+    folium.LayerControl().add_to(m)
+
+    # Save the map
+    m.save(MAP_HTML)
+    print(f"\nInteractive map saved as '{MAP_HTML}'")
+    print("Open this file in your web browser to view the visualization")
+
+
+if __name__ == "__main__":
+    metrics.run(main)
@@ -0,0 +1,65 @@
+# -----------------------------------------------------------
+# Hot-area geometry straight from coordinate arrays
+# -----------------------------------------------------------
+# visualize_reports.py used to buffer every complaint, union all the circles and keep
+# only the envelope of the result. The envelope of buffered points is just the point
+# bounds grown by the buffer radius, so it is computed from the x/y arrays instead.
+# Where an actual footprint is wanted, it is built per DBSCAN cluster: every cluster's
+# buffered points are unioned on its own, clusters in parallel, so no single union ever
+# spans the whole city. Everything works in NY State Plane feet (EPSG:2263).
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+import shapely
+
+BUFFER_FT = 25                         # radius drawn around each complaint
+
+
+def envelope_bounds(xy, buffer=BUFFER_FT):
+    """(minx, miny, maxx, maxy) of all points buffered by `buffer`.
+
+    Same as GeoSeries(points).buffer(buffer).union_all().envelope.bounds.
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    lo, hi = xy.min(axis=0) - buffer, xy.max(axis=0) + buffer
+    return float(lo[0]), float(lo[1]), float(hi[0]), float(hi[1])
+
+
+def cluster_envelopes(xy, labels, buffer=BUFFER_FT):
+    """Buffered bounds of every cluster: (ids, sizes, (k, 4) array of minx, miny, maxx, maxy).
+
+    Noise (-1) is left out; one sort and four reductions, no geometry.
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    labels = np.asarray(labels)
+    keep = labels != -1
+    order = np.argsort(labels[keep], kind="stable")
+    lab, pts = labels[keep][order], xy[keep][order]
+    if len(lab) == 0:
+        return np.empty(0, dtype=labels.dtype), np.empty(0, dtype=np.int64), np.empty((0, 4))
+    starts = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+    lo = np.minimum.reduceat(pts, starts) - buffer
+    hi = np.maximum.reduceat(pts, starts) + buffer
+    sizes = np.diff(np.r_[starts, len(lab)])
+    return lab[starts], sizes, np.column_stack([lo, hi])
+
+
+def cluster_footprints(xy, labels, clusters, buffer=BUFFER_FT, n_jobs=None):
+    """Union of each listed cluster's buffered points, one shapely geometry per cluster.
+
+    Clusters are unioned on a thread pool; shapely releases the GIL while it works.
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+
+    def footprint(cid):
+        lo, hi = np.searchsorted(sorted_labels, [cid, cid + 1])
+        points = shapely.points(xy[order[lo:hi]])
+        return shapely.union_all(shapely.buffer(points, buffer))
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        return list(pool.map(footprint, clusters))
@@ -0,0 +1,115 @@
+# -----------------------------------------------------------
+# Hand-off of hot bboxes from find_top_clusters.py to download.py
+# -----------------------------------------------------------
+# find_top_clusters.py writes each hot block to data/hot_bboxes.jsonl as soon as its
+# bbox is known: one JSON object per line with the cluster id, size, bbox and the time
+# it was computed. The file opens with a header line for the run and ends with a
+# {"done": true} line, or with an {"error": ...} line if the run failed. download.py
+# follows the file like `tail -f`, so downloads for the first cluster start while the
+# remaining ones are still being computed, and a failed run is not taken as complete.
+# A reader started together with find_top_clusters.py may open the file before the new
+# run replaces it; with new_run it skips a run that had already ended and waits for
+# the next one.
+
+from datetime import datetime, timezone
+from pathlib import Path
+import json, os, time
+
+HOT_BBOXES_PATH = Path("data/hot_bboxes.jsonl")
+POLL_SEC = 0.5
+
+
+class HotBBoxWriter:
+    """Append-only writer for one run's hot bboxes."""
+
+    def __init__(self, path=HOT_BBOXES_PATH):
+        self.path = Path(path)
+        self.run = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # start a fresh file (new inode) so readers of the previous run notice
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"run": self.run}) + "\n")
+        os.replace(tmp, self.path)
+        self.f = open(self.path, "a")
+
+    def write(self, bbox: dict):
+        """Publish one bbox (west/south/east/north, cid, size) immediately."""
+        record = dict(bbox, created=datetime.now(timezone.utc).isoformat(timespec="seconds"))
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+    def close(self, error=None):
+        """End the run with a done line, or with an error line if error is given."""
+        if not self.f.closed:
+            end = {"done": True} if error is None else {"error": error}
+            self.f.write(json.dumps({"run": self.run, **end}) + "\n")
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(None if exc is None else repr(exc))
+
+
+def _ended(path) -> bool:
+    """Whether the run in the file has already written its done or error line."""
+    with open(path) as f:
+        lines = [line for line in f if line.endswith("\n")]
+    last = json.loads(lines[-1]) if lines else {}
+    return bool(last.get("done")) or "error" in last
+
+
+def read_hot_bboxes(path=HOT_BBOXES_PATH, follow=True, poll=POLL_SEC, timeout=None,
+                    new_run=False):
+    """Yield bbox records as they are written, until the run's done line.
+
+    Without follow, stop at the end of the file. With follow, wait for new
+    lines (up to timeout seconds of silence, if given); if a new run replaces
+    the file meanwhile, continue with the new run. With new_run, a run that
+    had already ended when reading starts is skipped and the next one is read.
+    Raises RuntimeError at the error line of a failed run.
+    """
+    path = Path(path)
+    waited, skip = 0.0, None
+    while True:
+        if path.exists():
+            inode = os.stat(path).st_ino
+            if new_run and skip is None:
+                skip = inode if _ended(path) else -1
+            if inode != skip:
+                break
+        if not follow or (timeout is not None and waited >= timeout):
+            return
+        time.sleep(poll)
+        waited += poll
+
+    f = open(path)
+    try:
+        waited, buffer = 0.0, ""
+        while True:
+            line = f.readline()
+            if line:
+                buffer += line
+                if not buffer.endswith("\n"):      # writer is mid-line
+                    continue
+                record, buffer = json.loads(buffer), ""
+                if record.get("done"):
+                    return
+                if "error" in record:
+                    raise RuntimeError(f"hot bbox run {record['run']} failed: {record['error']}")
+                if "cid" in record:
+                    waited = 0.0
+                    yield record
+                continue
+
+            if not follow or (timeout is not None and waited >= timeout):
+                return
+            if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                f.close()                          # a new run replaced the file
+                f, buffer = open(path), ""
+                continue
+            time.sleep(poll)
+            waited += poll
+    finally:
+        f.close()
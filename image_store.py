@@ -0,0 +1,159 @@
+# -----------------------------------------------------------
+# Content-addressed image store with a SQLite download manifest
+# -----------------------------------------------------------
+# Hot bboxes overlap, so the same Mapillary image is often found in several clusters.
+# Each image is downloaded once into data/images/<sha256[:2]>/<sha256>.jpg and recorded
+# in data/images/manifest.sqlite with its byte size, checksum and the clusters that
+# reference it. Cluster folders (data/raw/cluster_<cid>/) get hard links to the stored
+# file, so later stages keep reading them as before.
+#
+# Downloads stream into data/images/partial/<id>.part and are moved into place only
+# once complete, so an interrupted run never leaves a truncated JPEG behind. The next
+# run resumes the .part file with an HTTP Range request and fetches only the missing bytes.
+
+from pathlib import Path
+import hashlib, json, os, shutil, sqlite3, threading, time
+
+STORE_DIR = Path("data/images")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    image_id   TEXT PRIMARY KEY,
+    sha256     TEXT NOT NULL,
+    bytes      INTEGER NOT NULL,
+    path       TEXT NOT NULL,
+    meta       TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS image_clusters (
+    image_id TEXT NOT NULL,
+    cluster  INTEGER NOT NULL,
+    PRIMARY KEY (image_id, cluster)
+);
+"""
+
+
+def sha256_file(path, block_size=1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_atomic(path: Path, text: str):
+    """Write text through a temporary sibling file so readers never see half of it."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+
+class ImageStore:
+    """Downloaded images keyed by content hash, shared by all clusters; thread-safe."""
+
+    def __init__(self, root=STORE_DIR):
+        self.root = Path(root)
+        self.partial = self.root / "partial"
+        self.partial.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.inflight = {}                    # image_id -> [lock held while downloading, users]
+        self.db = sqlite3.connect(self.root / "manifest.sqlite", check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, image_id):
+        """Stored path of an image, or None if it isn't (completely) on disk."""
+        with self.lock:
+            row = self.db.execute("SELECT path, bytes FROM images WHERE image_id = ?",
+                                  (str(image_id),)).fetchone()
+        if row is None:
+            return None
+        path = Path(row[0])
+        if not path.exists() or path.stat().st_size != row[1]:
+            return None
+        return path
+
+    def fetch(self, image_id, url, client, meta=None):
+        """Return the stored path of an image, downloading only what is missing."""
+        image_id = str(image_id)
+        with self.lock:
+            entry = self.inflight.setdefault(image_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:                    # one download per image, even across clusters
+                path = self.lookup(image_id)
+                if path is not None:
+                    return path
+                return self._download(image_id, url, client, meta)
+        finally:
+            # drop the lock once no thread uses it, so the dict stays small in long runs
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.inflight[image_id]
+
+    def _download(self, image_id, url, client, meta):
+        part = self.partial / f"{image_id}.part"
+        client.download(url, part, resume=True)
+        digest = sha256_file(part)
+        path = self.root / digest[:2] / f"{digest}.jpg"
+        path.parent.mkdir(exist_ok=True)
+        size = part.stat().st_size
+        os.replace(part, path)
+
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+                (image_id, digest, size, str(path), json.dumps(meta) if meta else None, time.time()))
+        return path
+
+    def remove(self, image_id):
+        """Delete a stored image and its manifest rows; returns the bytes freed."""
+        image_id = str(image_id)
+        with self.lock, self.db:
+            row = self.db.execute("SELECT path, bytes FROM images WHERE image_id = ?",
+                                  (image_id,)).fetchone()
+            self.db.execute("DELETE FROM images WHERE image_id = ?", (image_id,))
+            self.db.execute("DELETE FROM image_clusters WHERE image_id = ?", (image_id,))
+            # identical content under another id shares the file
+            shared = row is not None and self.db.execute(
+                "SELECT 1 FROM images WHERE path = ?", (row[0],)).fetchone() is not None
+        if row is None or shared:
+            return 0
+        Path(row[0]).unlink(missing_ok=True)
+        return row[1]
+
+    def add_cluster(self, image_id, cluster):
+        """Record that a cluster references an image."""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO image_clusters VALUES (?, ?)",
+                            (str(image_id), int(cluster)))
+
+    def clusters(self, image_id):
+        with self.lock:
+            rows = self.db.execute("SELECT cluster FROM image_clusters WHERE image_id = ? ORDER BY cluster",
+                                   (str(image_id),)).fetchall()
+        return [r[0] for r in rows]
+
+    @staticmethod
+    def link(path: Path, dest: Path):
+        """Expose a stored file at dest as a hard link (a copy across filesystems)."""
+        if dest.exists():
+            if dest.stat().st_size == path.stat().st_size:
+                return
+            dest.unlink()                     # truncated file from an older run
+        tmp = dest.with_name(dest.name + ".tmp")
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, dest)
@@ -0,0 +1,288 @@
+# -----------------------------------------------------------
+# On-demand street imagery by map tile
+# -----------------------------------------------------------
+# download.py fetches every image of every hot block up front. TileCache fetches
+# imagery only for the areas someone looks at: a map viewport or an inference job asks
+# for a bbox, the bbox is split into web-mercator tiles at TILE_ZOOM (~230 m across in
+# NYC), and each tile missing from the cache is searched and downloaded once, through
+# the same search and image store download.py uses. Every image belongs to the one tile
+# that contains its location. A tile where any image failed to download is served as is
+# and recorded as partial: its images count against the quota and can be evicted, and
+# the next request fetches it again (images already stored are reused).
+#
+# After a tile is served, its neighbors are fetched on a background pool, since views
+# pan. Tiles are listed in data/tiles/tiles.sqlite with their size and last use; when
+# the images pass DISK_QUOTA bytes, least recently used tiles are evicted with their
+# images, except the ones pinned: a tile is pinned while it is served, and a caller can
+# keep a bbox's tiles pinned until it is done with their image paths (see TileCache.pin).
+#
+# With TILE_IMAGERY set, pipeline.py fetches and scores each hot block's images through
+# this cache instead of downloading them into data/raw/cluster_<cid>/.
+#
+#   python imagery_tiles.py west south east north    # fetch a viewport
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+import json, logging, math, sqlite3, sys, threading, time
+
+import metrics
+from download import get_images_in_bbox, image_meta
+from image_store import ImageStore, write_atomic
+
+TILE_DIR         = Path("data/tiles")
+TILE_ZOOM        = 17
+DISK_QUOTA       = 2 * 1024**3         # bytes of cached images
+PREFETCH_RING    = 1                   # neighbor tiles fetched around each request
+PREFETCH_WORKERS = 2
+FETCH_WORKERS    = 8                   # image downloads at once per tile
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    tile      TEXT PRIMARY KEY,
+    images    TEXT NOT NULL,
+    bytes     INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    partial   INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used);
+"""
+
+log = logging.getLogger(__name__)
+
+
+def tile_for(lat, lon, z=TILE_ZOOM):
+    """(z, x, y) web-mercator tile containing a point."""
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return z, min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bbox(z, x, y):
+    """{west, south, east, north} of a tile."""
+    n = 2 ** z
+    lat = lambda t: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * t / n))))
+    return dict(west=x / n * 360 - 180, south=lat(y + 1), east=(x + 1) / n * 360 - 180, north=lat(y))
+
+
+def tiles_in_bbox(bbox, z=TILE_ZOOM):
+    """Every tile overlapping a {west, south, east, north} bbox."""
+    _, x0, y0 = tile_for(bbox["north"], bbox["west"], z)
+    _, x1, y1 = tile_for(bbox["south"], bbox["east"], z)
+    return [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def neighbors(tile, ring=PREFETCH_RING):
+    z, x, y = tile
+    n = 2 ** z
+    return [(z, x + dx, y + dy) for dx in range(-ring, ring + 1) for dy in range(-ring, ring + 1)
+            if (dx or dy) and 0 <= x + dx < n and 0 <= y + dy < n]
+
+
+def _name(tile):
+    return "/".join(map(str, tile))
+
+
+class TileCache:
+    """Tile-keyed, quota-bounded cache of Mapillary images; thread-safe."""
+
+    def __init__(self, client, root=TILE_DIR, quota=DISK_QUOTA, prefetch_ring=PREFETCH_RING,
+                 prefetch_workers=PREFETCH_WORKERS, fetch_workers=FETCH_WORKERS):
+        self.client = client
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.store = ImageStore(self.root / "images")
+        self.quota = quota
+        self.prefetch_ring = prefetch_ring
+        self.lock = threading.Lock()
+        self.inflight = {}                    # tile name -> [lock held while fetching, users]
+        self.pinned = {}                      # tile name -> holders; never evicted
+        self.db = sqlite3.connect(self.root / "tiles.sqlite", check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        self.total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM tiles").fetchone()[0]
+        self.fetchers = ThreadPoolExecutor(fetch_workers)
+        self.prefetcher = ThreadPoolExecutor(prefetch_workers) if prefetch_ring else None
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(cancel_futures=True)
+        self.fetchers.shutdown()
+        self.db.close()
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextmanager
+    def pin(self, tiles):
+        """Keep tiles from being evicted inside the with block, so their paths stay valid."""
+        names = [_name(t) for t in tiles]
+        with self.lock:
+            for name in names:
+                self.pinned[name] = self.pinned.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                for name in names:
+                    self.pinned[name] -= 1
+                    if self.pinned[name] == 0:
+                        del self.pinned[name]
+
+    def _cached(self, name, touch=True):
+        """Images of a completely fetched tile, or None (partial tiles are fetched again)."""
+        with self.lock, self.db:
+            row = self.db.execute("SELECT images FROM tiles WHERE tile = ? AND NOT partial",
+                                  (name,)).fetchone()
+            if row is not None and touch:
+                self.db.execute("UPDATE tiles SET last_used = ? WHERE tile = ?", (time.time(), name))
+        return None if row is None else json.loads(row[0])
+
+    def get_tile(self, tile, prefetch=True):
+        """Metadata (with local "path") of every image in a tile, fetching it if needed.
+
+        Paths stay valid until the tile is evicted; hold it with pin() while using them.
+        """
+        tile = tuple(tile)
+        with self.pin([tile]):
+            images = self._cached(_name(tile))
+            metrics.count("tile_cache", result="miss" if images is None else "hit")
+            if images is None:
+                images = self._fetch(tile)
+        if prefetch and self.prefetcher is not None:
+            for t in neighbors(tile, self.prefetch_ring):
+                if self._cached(_name(t), touch=False) is None:
+                    self.prefetcher.submit(self._prefetch, t)
+        return images
+
+    def _prefetch(self, tile):
+        try:
+            if self._cached(_name(tile), touch=False) is None:
+                self._fetch(tile)
+                metrics.count("tile_prefetch")
+        except Exception as e:
+            log.warning(f" ! prefetch of tile {_name(tile)} failed: {e}")
+
+    def _fetch(self, tile):
+        name = _name(tile)
+        with self.lock:
+            entry = self.inflight.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:                    # one fetch per tile, requests and prefetch alike
+                images = self._cached(name)
+                if images is not None:
+                    return images
+                with metrics.timer("tile_fetch"):
+                    images, failed = self._download(tile)
+                size = sum(img.pop("bytes") for img in images)
+                if failed:
+                    metrics.count("tile_partial")
+                    log.warning(f" ! {failed} images of tile {name} failed; will retry")
+                with self.lock, self.db:
+                    # a partial tile being fetched again replaces its earlier row
+                    old = self.db.execute("SELECT bytes FROM tiles WHERE tile = ?",
+                                          (name,)).fetchone()
+                    self.db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)",
+                                    (name, json.dumps(images), size, time.time(), bool(failed)))
+                    self.total += size - (old[0] if old else 0)
+                self._evict()
+                return images
+        finally:
+            # drop the lock once no thread uses it, as ImageStore.fetch does
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.inflight[name]
+
+    def _download(self, tile):
+        """(images this tile owns, number of images that failed to download)."""
+        bbox = tile_bbox(*tile)
+        found = get_images_in_bbox(bbox, self.client)
+        if found is None:
+            raise RuntimeError(f"image search failed for tile {_name(tile)}")
+
+        def fetch(img):
+            meta = image_meta(img, None, self.client)
+            # the search is inclusive at the edges: keep images this tile owns
+            if meta is None or tile_for(meta["lat"], meta["lon"], tile[0]) != tile:
+                return None
+            path = self.store.fetch(meta["id"], meta["image_url"], self.client, meta)
+            meta.pop("full_response")
+            # metadata next to the image, as download.py saves it (report_311.py reads it)
+            sidecar = path.with_suffix(".json")
+            if not sidecar.exists():
+                write_atomic(sidecar, json.dumps(meta, indent=2))
+            return dict(meta, tile=_name(tile), path=str(path), bytes=path.stat().st_size)
+
+        images, failed = [], 0
+        for future in as_completed([self.fetchers.submit(fetch, img) for img in found]):
+            try:
+                meta = future.result()
+            except Exception as e:
+                log.warning(f" ! Error downloading an image of tile {_name(tile)}: {e}")
+                failed += 1
+                continue
+            if meta is not None:
+                images.append(meta)
+        return sorted(images, key=lambda m: str(m["id"])), failed
+
+    def _evict(self):
+        """Drop least recently used tiles and their images until under quota."""
+        with self.lock:
+            if self.total <= self.quota:
+                return
+            rows = self.db.execute("SELECT tile, images, bytes FROM tiles ORDER BY last_used").fetchall()
+            victims = []
+            for name, images, size in rows:
+                if self.total <= self.quota:
+                    break
+                if name in self.pinned:
+                    continue
+                victims.append((name, json.loads(images)))
+                self.total -= size
+            with self.db:
+                self.db.executemany("DELETE FROM tiles WHERE tile = ?", [(v[0],) for v in victims])
+        for name, images in victims:
+            for img in images:
+                if self.store.remove(img["id"]):
+                    Path(img["path"]).with_suffix(".json").unlink(missing_ok=True)
+            metrics.count("tile_evictions")
+            log.debug(f"Evicted tile {name}")
+
+    def images_in_bbox(self, bbox):
+        """Images inside a viewport bbox, fetching its missing tiles in parallel.
+
+        Their paths can be evicted once this returns; hold pin(tiles_in_bbox(bbox)) to use them.
+        """
+        tiles = tiles_in_bbox(bbox)
+        if not tiles:                         # inverted or degenerate bbox
+            return []
+        # tiles fetched first must survive the eviction after the later ones
+        with self.pin(tiles), ThreadPoolExecutor(min(len(tiles), PREFETCH_WORKERS + 2)) as pool:
+            per_tile = list(pool.map(self.get_tile, tiles))
+        return [img for images in per_tile for img in images
+                if bbox["south"] <= img["lat"] <= bbox["north"]
+                and bbox["west"] <= img["lon"] <= bbox["east"]]
+
+
+def main(bbox):
+    from download import get_token
+    from mapillary_client import MapillaryClient
+
+    with MapillaryClient(get_token()) as client, TileCache(client) as cache:
+        images = cache.images_in_bbox(bbox)
+        print(f"{len(images)} images in {len(tiles_in_bbox(bbox))} tiles "
+              f"({cache.total / 2**20:.1f} MiB cached)")
+        # let the neighbor prefetch finish before the pools shut down
+        if cache.prefetcher is not None:
+            cache.prefetcher.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    west, south, east, north = map(float, sys.argv[1:5])
+    metrics.run(main, dict(west=west, south=south, east=east, north=north))
@@ -0,0 +1,231 @@
+# -----------------------------------------------------------
+# Incremental DBSCAN: fold new 311 complaints into saved clusters
+# -----------------------------------------------------------
+# find_top_clusters.py re-clusters the whole history on every run. This module keeps
+# the clustering state on disk (points, neighbor counts, union-find parents, cluster
+# roots and the grid index) under data/cluster_state/, together with the path of the
+# CSV it was built from, and folds in only the rows it has not clustered yet. If a
+# clustered complaint is missing from the export (a rolling export dropped it, or this
+# is a different dataset), the state is rebuilt from scratch.
+#
+# Points are added in Unique Key order. Adding points can only grow neighborhoods, so
+# existing clusters never split: new core points are joined to their core neighbors,
+# and only border points next to a core point whose cluster changed are re-checked.
+# The resulting clusters equal a full DBSCAN run over the same points. The complaint
+# cache keeps the CSV's order, so ClusterState.labels(keys) renumbers the clusters in
+# that order and both modes of find_top_clusters.py give the same cluster ids.
+#
+# The same structure gives time-windowed hotspots in one pass: walking complaints from
+# newest to oldest, the last 7 days are a prefix of the last 30, which are a prefix of
+# the last 90, so each longer window just adds the older slice to the previous one.
+
+from dataclasses import dataclass
+from pathlib import Path
+import json, os, shutil, tempfile
+
+import numpy as np
+
+from clustering import (CHUNK_SIZE, EPS_FT, MIN_SAMPLES, GridIndex, _chunks, core_roots,
+                        join_cores, label_borders, neighbor_counts, rank_roots)
+from complaints import CSV_PATH, load_complaints
+
+STATE_DIR = Path("data/cluster_state")
+
+_ARRAYS = ("xy", "unique_key", "counts", "parent", "roots", "order", "keys")
+
+
+@dataclass
+class ClusterState:
+    """Everything needed to extend a DBSCAN run with new points."""
+    eps:         float
+    min_samples: int
+    xy:          np.ndarray            # (n, 2) projected ft
+    unique_key:  np.ndarray            # int64, in the order the points were added
+    counts:      np.ndarray            # neighbors within eps, self included
+    parent:      np.ndarray            # union-find over core points
+    roots:       np.ndarray            # cluster root per point, -1 = noise
+    order:       np.ndarray            # GridIndex.order
+    keys:        np.ndarray            # GridIndex.keys
+    source:      str | None = None     # resolved path of the CSV the points came from
+
+    @classmethod
+    def empty(cls, eps=EPS_FT, min_samples=MIN_SAMPLES, source=None):
+        none = np.empty(0, dtype=np.int64)
+        return cls(eps, min_samples, np.empty((0, 2)), none, none, none, none, none, none, source)
+
+    def index(self):
+        return GridIndex(self.xy, self.eps, order=self.order, keys=self.keys)
+
+    def labels(self, keys=None):
+        """DBSCAN labels (0..k-1, -1 = noise) numbered like sklearn.
+
+        Without keys the labels follow the order the points were added in. keys
+        are the same points' Unique Keys in another order (e.g. the complaint
+        cache); the labels are then returned in that order and equal
+        dbscan_labels() over the points in that order.
+        """
+        if keys is None:
+            return rank_roots(self.roots)
+        keys = np.asarray(keys, dtype=np.int64)
+        n = len(self.unique_key)
+        if len(keys) != n:
+            raise ValueError(f"Expected the {n} clustered Unique Keys, got {len(keys)}")
+        if n == 0:
+            return np.empty(0, dtype=np.int64)
+        sorter = np.argsort(self.unique_key, kind="stable")
+        at = sorter[np.minimum(np.searchsorted(self.unique_key, keys, sorter=sorter), n - 1)]
+        if not np.array_equal(self.unique_key[at], keys):
+            raise ValueError("keys are not the Unique Keys of the clustered points")
+
+        # a full run numbers clusters by their first core point and gives each
+        # border point the lowest-numbered cluster among its core neighbors
+        pos = np.empty(n, dtype=np.int64)
+        pos[at] = np.arange(n)
+        is_core = self.counts >= self.min_samples
+        first = np.full(n, n, dtype=np.int64)
+        np.minimum.at(first, self.roots[is_core], pos[is_core])
+        roots = np.full(n, -1, dtype=np.int64)
+        roots[is_core] = first[self.roots[is_core]]
+        border = np.flatnonzero(~is_core & (self.roots >= 0))
+        label_borders(self.index(), roots, is_core, border, self.eps)
+        return rank_roots(roots)[at]
+
+
+def add_points(state, new_xy, new_keys):
+    """Return a new state with the given points appended."""
+    new_xy = np.asarray(new_xy, dtype=np.float64).reshape(-1, 2)
+    new_keys = np.asarray(new_keys, dtype=np.int64)
+    n0, m = len(state.xy), len(new_xy)
+    if m == 0:
+        return state
+
+    eps = state.eps
+    index = state.index().extended(new_xy)
+    new_idx = np.arange(n0, n0 + m)
+
+    # neighbor counts: new points query the full index, and each old point
+    # found by those queries gains one neighbor per new point near it
+    counts = np.concatenate([state.counts, neighbor_counts(index, new_idx, eps)])
+    if n0:
+        for chunk in index.chunks(new_idx):
+            _, p = index.pairs(index.xy[chunk], eps)
+            np.add.at(counts, p[p < n0], 1)
+
+    was_core = np.zeros(n0 + m, dtype=bool)
+    was_core[:n0] = state.counts >= state.min_samples
+    is_core = counts >= state.min_samples
+    became_core = np.flatnonzero(is_core & ~was_core)
+
+    # every new core-core edge has at least one newly core end
+    parent = np.concatenate([state.parent, new_idx])
+    join_cores(index, parent, is_core, became_core, eps)
+    roots = core_roots(parent, is_core)
+
+    # borders keep the smallest neighboring root; it can only change next to
+    # a core point whose root changed (merge or new core) or for new points.
+    # Those are found from the non-core side, as dense spots are mostly cores
+    old_roots = np.concatenate([state.roots, np.full(m, -1, dtype=np.int64)])
+    changed = np.flatnonzero(is_core & ((roots != old_roots) | ~was_core))
+    around = index.around(changed)
+    around = around[~is_core[around]]
+    hubs = GridIndex(index.xy[changed], eps)
+    recheck = [new_idx]
+    for chunk in _chunks(around, CHUNK_SIZE, hubs.candidates(index.xy[around])):
+        q, _ = hubs.pairs(index.xy[chunk], eps)
+        recheck.append(chunk[np.unique(q)])
+    recheck = np.unique(np.concatenate(recheck))
+    recheck = recheck[~is_core[recheck]]
+    roots[~is_core] = old_roots[~is_core]
+    roots[recheck] = -1
+    label_borders(index, roots, is_core, recheck, eps)
+
+    return ClusterState(eps, state.min_samples, index.xy,
+                        np.concatenate([state.unique_key, new_keys]),
+                        counts, parent, roots, index.order, index.keys, state.source)
+
+
+def load_state(state_dir=STATE_DIR, eps=EPS_FT, min_samples=MIN_SAMPLES, source=None):
+    """Load the saved state, or an empty one if none exists for these parameters and source."""
+    state_dir = Path(state_dir)
+    meta_path = state_dir / "meta.json"
+    if not meta_path.exists():
+        return ClusterState.empty(eps, min_samples, source)
+    meta = json.loads(meta_path.read_text())
+    if meta["eps"] != eps or meta["min_samples"] != min_samples or meta.get("source") != source:
+        return ClusterState.empty(eps, min_samples, source)
+    arrays = {name: np.load(state_dir / f"{name}.npy") for name in _ARRAYS}
+    return ClusterState(meta["eps"], meta["min_samples"], **arrays, source=source)
+
+
+def save_state(state, state_dir=STATE_DIR):
+    """Write the state through a temporary folder and swap it in."""
+    state_dir = Path(state_dir)
+    state_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=state_dir.parent, prefix=".state-"))
+    for name in _ARRAYS:
+        np.save(tmp / f"{name}.npy", getattr(state, name))
+    (tmp / "meta.json").write_text(json.dumps({
+        "eps": state.eps,
+        "min_samples": state.min_samples,
+        "points": len(state.xy),
+        "source": state.source,
+    }, indent=2))
+    old = state_dir.with_name(state_dir.name + ".old")
+    if state_dir.exists():
+        os.replace(state_dir, old)
+    os.replace(tmp, state_dir)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def refresh_clusters(csv_path=CSV_PATH, state_dir=STATE_DIR, eps=EPS_FT, min_samples=MIN_SAMPLES):
+    """Fold complaints not clustered yet into the saved clusters and save them.
+
+    The state belongs to one CSV path. If the export no longer holds every
+    clustered complaint, the clusters would drift from it, so they are rebuilt.
+    """
+    source = str(Path(csv_path).resolve())
+    state = load_state(state_dir, eps, min_samples, source)
+    pts = load_complaints(csv_path, columns=("unique_key", "x", "y"))
+    keys = np.asarray(pts["unique_key"])
+    known = np.isin(keys, state.unique_key)
+    if np.count_nonzero(known) != len(state.unique_key):
+        print(f"{len(state.unique_key) - np.count_nonzero(known)} clustered complaints "
+              f"left the export, rebuilding the clusters")
+        state = ClusterState.empty(eps, min_samples, source)
+        known[:] = False
+    new = np.flatnonzero(~known)
+    new = new[np.argsort(keys[new], kind="stable")]
+    print(f"Adding {len(new)} new complaints to {len(state.xy)} clustered points")
+    if len(new):
+        xy = np.column_stack([pts["x"][new], pts["y"][new]])
+        state = add_points(state, xy, keys[new])
+        save_state(state, state_dir)
+    return state
+
+
+def window_labels(created, xy, days=(7, 30, 90), now=None, eps=EPS_FT, min_samples=MIN_SAMPLES):
+    """Yield (days, rows, labels) for each window of the last `days` days before now.
+
+    rows are indices into created/xy, newest first, and labels are the DBSCAN
+    labels of those rows. Windows share one incremental state, so every point
+    is clustered once. now defaults to the newest complaint; a window with no
+    complaints yields empty rows and labels.
+    """
+    created = np.asarray(created).astype("datetime64[s]")
+    order = np.argsort(created, kind="stable")[::-1]           # newest first
+    if now is not None:
+        now = np.datetime64(now, "s")
+    elif len(order):
+        now = created[order[0]]
+    else:                                                      # no complaints: empty windows
+        now = np.datetime64(0, "s")
+    order = order[created[order] <= now]
+    age = now - created[order]                                 # ascending
+
+    state, done = ClusterState.empty(eps, min_samples), 0
+    for d in sorted(days):
+        stop = int(np.searchsorted(age, np.timedelta64(d, "D"), side="left"))
+        rows = order[done:stop]
+        state = add_points(state, np.asarray(xy)[rows], rows)
+        done = stop
+        yield d, order[:stop], state.labels()
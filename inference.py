@@ -1,12 +1,11 @@
-import moondream as md
 from PIL import Image, ImageDraw
-import os
+from batch_inference import get_model
+from inference_cache import InferenceCache
 
-# This will run the model locally
-#model = md.vl(endpoint="http://localhost:2020/v1")
-
-# For Moondream Cloud, use your API key:
-model = md.vl(api_key=os.getenv("MOONDREAM_TOKEN"))
+# Moondream Cloud with MOONDREAM_TOKEN, or a local model with
+# MOONDREAM_ENDPOINT=http://localhost:2020/v1. Earlier answers for the same
+# image, model and prompt are reused (data/inference/cache.sqlite)
+model = get_model(InferenceCache())
 
 
 # Load an image
@@ -0,0 +1,116 @@
+# -----------------------------------------------------------
+# Persistent cache of Moondream detect/query results
+# -----------------------------------------------------------
+# Model calls are the slowest and most expensive step, and most Mapillary frames of a
+# hot block do not change between runs. Results are cached in
+# data/inference/cache.sqlite, keyed by (image content hash, model id, call type,
+# prompt). When the cache grows past MAX_CACHE_BYTES, the least recently used
+# entries are evicted down to EVICT_TO of it, so eviction runs once per batch of
+# new results rather than on every put.
+
+from pathlib import Path
+import hashlib, json, sqlite3, threading, time
+
+import metrics
+
+CACHE_PATH      = Path("data/inference/cache.sqlite")
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+EVICT_TO        = 0.9                  # fraction of MAX_CACHE_BYTES left after an eviction
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key       TEXT PRIMARY KEY,
+    value     TEXT NOT NULL,
+    bytes     INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+"""
+
+
+def image_hash(img) -> str:
+    """Content hash of a decoded PIL image (pixels, size and mode)."""
+    h = hashlib.sha256(f"{img.mode}:{img.size}".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+class InferenceCache:
+    """SQLite-backed LRU cache of JSON-serializable model results; thread-safe."""
+
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        self.total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def key(image_key, model_id, call, prompt) -> str:
+        return json.dumps([image_key, model_id, call, prompt])
+
+    def get(self, key):
+        """Cached value, or None; a hit marks the entry as recently used."""
+        with self.lock, self.db:
+            row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """Store a value; past max_bytes, evict least recently used entries down to EVICT_TO."""
+        text = json.dumps(value)
+        size = len(key) + len(text)
+        with self.lock, self.db:
+            old = self.db.execute("SELECT bytes FROM results WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                            (key, text, size, time.time()))
+            self.total += size - (old[0] if old else 0)
+            if self.total > self.max_bytes:
+                target = self.max_bytes * EVICT_TO
+                victims = self.db.execute(
+                    "SELECT key, bytes FROM results WHERE key != ? ORDER BY last_used", (key,))
+                evict = []
+                for k, b in victims:             # read only as many rows as get evicted
+                    if self.total <= target:
+                        break
+                    evict.append((k,))
+                    self.total -= b
+                self.db.executemany("DELETE FROM results WHERE key = ?", evict)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CachedModel:
+    """Wraps a Moondream model so detect/query results come from the cache when possible."""
+
+    def __init__(self, model, model_id, cache):
+        self.model = model
+        self.model_id = model_id
+        self.cache = cache
+
+    def _call(self, call, img, prompt, image_key):
+        key = self.cache.key(image_key or image_hash(img), self.model_id, call, prompt)
+        result = self.cache.get(key)
+        metrics.count("model_cache", call=call, result="miss" if result is None else "hit")
+        if result is None:
+            with metrics.timer("model_call", call=call):
+                result = getattr(self.model, call)(img, prompt)
+            self.cache.put(key, result)
+        return result
+
+    def detect(self, img, prompt, image_key=None):
+        return self._call("detect", img, prompt, image_key)
+
+    def query(self, img, question, image_key=None):
+        return self._call("query", img, question, image_key)
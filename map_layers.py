@@ -0,0 +1,96 @@
+# -----------------------------------------------------------
+# Folium layers that scale to citywide complaint data
+# -----------------------------------------------------------
+# Adding one folium.CircleMarker per row writes a separate JS block per point, so
+# citywide maps reach hundreds of MB. These helpers emit a whole set of points as
+# one compact [lat, lon, group] array drawn by a single FastMarkerCluster callback
+# (points are grouped when zoomed out and drawn as circles at street level). Past
+# MAX_VECTOR_POINTS, points are rasterized into one density image overlay instead.
+
+import json
+
+import numpy as np
+from folium.plugins import FastMarkerCluster, HeatMap
+from folium.raster_layers import ImageOverlay
+from PIL import ImageColor
+
+MAX_VECTOR_POINTS = 250_000            # above this, draw a density raster
+RASTER_SIZE       = 2048               # raster width/height in pixels
+CLUSTER_UNTIL_ZOOM = 16                # draw individual circles from this zoom on
+
+# styles and popups are built once, outside the per-marker function
+_CALLBACK = """
+(function () {
+    var styles = %s;
+    var popups = %s;
+    return function (row) {
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), styles[row[2]]);
+        if (popups) { marker.bindPopup(popups[row[2]]); }
+        return marker;
+    };
+})()
+"""
+
+
+def cluster_sizes(labels) -> np.ndarray:
+    """Points per cluster id (noise, -1, excluded), computed once for all popups."""
+    labels = np.asarray(labels)
+    return np.bincount(labels[labels != -1])
+
+
+def add_points(m, lat, lon, colors, groups=None, popups=None, radius=4, fill_opacity=0.7,
+               name=None, max_points=MAX_VECTOR_POINTS):
+    """Draw points on the map as a single layer.
+
+    colors (and popups, if given) are lists indexed by groups, one int per point;
+    without groups every point uses colors[0] and popups[0].
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    groups = np.zeros(len(lat), dtype=np.int64) if groups is None else np.asarray(groups)
+    if len(lat) == 0:
+        return None
+    if len(lat) > max_points:
+        return add_density(m, lat, lon, colors[0], name=name)
+
+    styles = [dict(radius=radius, color=c, fill=True, fillColor=c,
+                   fillOpacity=fill_opacity, weight=1) for c in colors]
+    # 6 decimals is ~0.1 m, plenty for street-level markers; an object array keeps the
+    # group an int in the JSON while numpy converts every value
+    rows = np.empty((len(lat), 3), dtype=object)
+    rows[:, 0], rows[:, 1] = np.round(lat, 6), np.round(lon, 6)
+    rows[:, 2] = groups.astype(np.int64)
+    rows = rows.tolist()
+    callback = _CALLBACK % (json.dumps(styles), json.dumps(popups))
+    return FastMarkerCluster(rows, callback=callback, name=name,
+                             disableClusteringAtZoom=CLUSTER_UNTIL_ZOOM,
+                             chunkedLoading=True).add_to(m)
+
+
+def add_density(m, lat, lon, color, name=None, size=RASTER_SIZE):
+    """Rasterize points into a transparent count image laid over their bounds."""
+    south, north = lat.min(), lat.max()
+    west, east = lon.min(), lon.max()
+    counts, _, _ = np.histogram2d(lat, lon, bins=size, range=[[south, north], [west, east]])
+    counts = counts[::-1]                       # row 0 is the northern edge
+
+    rgba = np.zeros(counts.shape + (4,), dtype=np.float64)
+    rgba[..., :3] = np.array(ImageColor.getrgb(color)[:3]) / 255
+    rgba[..., 3] = np.log1p(counts) / max(np.log1p(counts.max()), 1.0)
+    return ImageOverlay(rgba, bounds=[[south, west], [north, east]], mercator_project=True,
+                        name=name, pixelated=True).add_to(m)
+
+
+def add_heatmap(m, lat, lon, weights, name=None, radius=15, max_points=MAX_VECTOR_POINTS):
+    """Weighted heatmap, e.g. of cell centers and their counts (see cell_bins.py).
+
+    Past max_points only the heaviest ones are drawn.
+    """
+    lat, lon, weights = np.asarray(lat), np.asarray(lon), np.asarray(weights, dtype=np.float64)
+    if len(weights) > max_points:
+        keep = np.argpartition(-weights, max_points - 1)[:max_points]
+        lat, lon, weights = lat[keep], lon[keep], weights[keep]
+    if len(weights) == 0:
+        return None
+    data = np.column_stack([np.round(lat, 6), np.round(lon, 6), weights / weights.max()]).tolist()
+    return HeatMap(data, name=name, radius=radius).add_to(m)
@@ -0,0 +1,190 @@
+# -----------------------------------------------------------
+# Pooled, rate-limited HTTP client for the Mapillary API v4
+# -----------------------------------------------------------
+# download.py used to call requests.get for every request and sleep 0.5 s after each
+# image. MapillaryClient shares one requests.Session (keep-alive connection pool)
+# across worker threads. A token bucket spaces API calls to stay under Mapillary's
+# quota, and 429/5xx responses are retried with exponential backoff, honoring
+# Retry-After. The API base URL can be pointed at a local HTTP stand-in for testing
+# (MAPILLARY_API_URL).
+#
+# Every attempt is timed and counted per endpoint ("api" or "cdn") and status, together
+# with retries, rate-limit waits and body bytes (see metrics.py).
+
+from pathlib import Path
+import os, random, threading, time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+API_URL      = os.getenv("MAPILLARY_API_URL", "https://graph.mapillary.com")
+RATE_PER_SEC = 10                      # API calls per second (entity quota is far higher)
+BURST        = 20                      # calls allowed back to back after idling
+MAX_RETRIES  = 5
+BACKOFF_SEC  = 0.5                     # first retry delay, doubled each attempt
+TIMEOUT_SEC  = 30
+POOL_SIZE    = 16                      # keep-alive connections per host
+SEARCH_LIMIT = 1000                    # most images the bbox search returns per call
+MIN_TILE_DEG = 1e-4                    # stop splitting dense bboxes below ~10 m
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `capacity` saved up."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class MapillaryClient:
+    """Mapillary API v4 access over one pooled session, safe to share between threads."""
+
+    def __init__(self, access_token, api_url=API_URL, rate=RATE_PER_SEC, burst=BURST,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF_SEC, timeout=TIMEOUT_SEC,
+                 pool_size=POOL_SIZE):
+        self.access_token = access_token
+        self.api_url = api_url.rstrip("/")
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Authorization"] = f"OAuth {access_token}"
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _request(self, url, params=None, stream=False, limited=True, headers=None):
+        """GET with retries on connection errors, 429 and 5xx; returns the response."""
+        endpoint = "api" if limited else "cdn"
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                metrics.count("http_retries", endpoint=endpoint)
+            if limited:
+                with metrics.timer("http_rate_wait"):
+                    self.bucket.acquire()
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, params=params, stream=stream, timeout=self.timeout,
+                                     headers=headers)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.observe("http_request", time.perf_counter() - start,
+                                endpoint=endpoint, status=type(e).__name__)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._delay(attempt))
+                continue
+            # with stream=True this is the time to the response headers
+            metrics.observe("http_request", time.perf_counter() - start,
+                            endpoint=endpoint, status=r.status_code)
+            if r.status_code in RETRY_STATUS and attempt < self.max_retries:
+                retry_after = r.headers.get("Retry-After")
+                r.close()
+                time.sleep(float(retry_after) if retry_after and retry_after.isdigit()
+                           else self._delay(attempt))
+                continue
+            r.raise_for_status()
+            return r
+
+    def _delay(self, attempt):
+        """Exponential backoff with jitter so workers don't retry in lockstep."""
+        return self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+
+    def get_json(self, path, params=None):
+        """GET an API path (e.g. "images" or an image id) and decode the JSON body."""
+        params = dict(params or {}, access_token=self.access_token)
+        return self._json(self._request(f"{self.api_url}/{path}", params=params))
+
+    def get_json_url(self, url):
+        """GET an absolute API URL, such as a paging.next link."""
+        params = None if "access_token=" in url else {"access_token": self.access_token}
+        return self._json(self._request(url, params=params))
+
+    @staticmethod
+    def _json(r):
+        metrics.count("http_bytes", len(r.content), endpoint="api")
+        return r.json()
+
+    def search_images(self, bbox, fields, limit=SEARCH_LIMIT):
+        """All images in a {west, south, east, north} bbox, with the requested fields.
+
+        Follows paging.next links. A tile whose last page comes back full may
+        have been truncated, so it is split into quadrants and searched again;
+        results are de-duplicated by image id.
+        """
+        found = {}
+        tiles = [(bbox["west"], bbox["south"], bbox["east"], bbox["north"])]
+        while tiles:
+            w, s, e, n = tiles.pop()
+            params = {"bbox": f"{w},{s},{e},{n}", "fields": ",".join(fields), "limit": limit}
+            page = self.get_json("images", params)
+            data = list(page.get("data", []))
+            while page.get("paging", {}).get("next"):
+                page = self.get_json_url(page["paging"]["next"])
+                data.extend(page.get("data", []))
+
+            # a full last page with no next link means the search was capped
+            capped = len(page.get("data", [])) >= limit
+            if capped and (e - w) > MIN_TILE_DEG and (n - s) > MIN_TILE_DEG:
+                mx, my = (w + e) / 2, (s + n) / 2
+                tiles += [(w, s, mx, my), (mx, s, e, my), (w, my, mx, n), (mx, my, e, n)]
+                continue
+            for img in data:
+                found[img["id"]] = img
+        return list(found.values())
+
+    def download(self, url, dest: Path, chunk_size=16384, resume=False):
+        """Stream a file (e.g. an image thumbnail) to dest; returns bytes written.
+
+        With resume, an existing dest is continued with a Range request; if the
+        server ignores the range, the file is fetched again from the start.
+        Thumbnail URLs point at Mapillary's CDN, not the API, so they are not
+        counted against the API rate limit.
+        """
+        offset = dest.stat().st_size if resume and dest.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+        written = 0
+        try:
+            r = self._request(url, stream=True, limited=False, headers=headers)
+        except requests.HTTPError as e:
+            if offset and e.response is not None and e.response.status_code == 416:
+                return 0                          # dest already holds the whole file
+            raise
+        with r, metrics.timer("http_body", endpoint="cdn"):
+            mode = "ab" if offset and r.status_code == 206 else "wb"
+            with open(dest, mode) as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    written += len(chunk)
+        metrics.count("http_bytes", written, endpoint="cdn")
+        return written
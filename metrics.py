@@ -0,0 +1,176 @@
+# -----------------------------------------------------------
+# Timers and counters for the hot paths
+# -----------------------------------------------------------
+# CSV load, reprojection, clustering, every HTTP call and every model call record into
+# one in-process registry: timers keep count, total and max seconds, counters keep a
+# sum (bytes, retries, cache hits). Each sample is a dict update under a lock, so the
+# hot loops pay next to nothing.
+#
+# Scripts run their main() through run(), which reads three environment variables:
+#   METRICS_PATH  write the registry when the run ends: Prometheus text if the name ends
+#                 in .prom (e.g. for node_exporter's textfile collector), else one JSON
+#                 line per metric appended to the file
+#   PROFILE_PATH  run under cProfile and save the stats there (open with pstats or
+#                 snakeviz); py-spy needs no switch: py-spy record -- python download.py
+#   LOG_LEVEL     DEBUG shows per-image progress lines; the default INFO hides them
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+import json, logging, os, re, threading, time
+
+METRICS_PATH = os.getenv("METRICS_PATH")
+PROFILE_PATH = os.getenv("PROFILE_PATH")
+LOG_LEVEL    = os.getenv("LOG_LEVEL", "INFO")
+
+PREFIX = "sidewalk_"                   # Prometheus metric name prefix
+
+_lock = threading.Lock()
+_timers = {}                           # (name, labels) -> [count, total s, max s]
+_counters = {}                         # (name, labels) -> value
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(name, seconds, **labels):
+    """Record one timed call."""
+    key = _key(name, labels)
+    with _lock:
+        t = _timers.get(key)
+        if t is None:
+            _timers[key] = [1, seconds, seconds]
+        else:
+            t[0] += 1
+            t[1] += seconds
+            if seconds > t[2]:
+                t[2] = seconds
+
+
+def count(name, value=1, **labels):
+    """Add value to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the block, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def snapshot() -> list:
+    """Every metric as a JSON-serializable dict."""
+    with _lock:
+        out = [dict(type="timer", name=name, labels=dict(labels), count=t[0],
+                    sum_s=round(t[1], 6), max_s=round(t[2], 6))
+               for (name, labels), t in sorted(_timers.items())]
+        out += [dict(type="counter", name=name, labels=dict(labels), value=v)
+                for (name, labels), v in sorted(_counters.items())]
+    return out
+
+
+def merge(metrics):
+    """Fold a snapshot (e.g. from a worker process) into this registry."""
+    with _lock:
+        for m in metrics:
+            key = _key(m["name"], m["labels"])
+            if m["type"] == "counter":
+                _counters[key] = _counters.get(key, 0) + m["value"]
+                continue
+            t = _timers.setdefault(key, [0, 0.0, 0.0])
+            t[0] += m["count"]
+            t[1] += m["sum_s"]
+            t[2] = max(t[2], m["max_s"])
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def collect(fn, *args):
+    """Run fn with an empty registry and return its metrics; for worker processes."""
+    reset()
+    fn(*args)
+    return snapshot()
+
+
+def _prom_name(name):
+    return PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def prometheus_text(metrics) -> str:
+    lines, typed = [], set()
+    for m in metrics:
+        labels = _prom_labels(m["labels"])
+        if m["type"] == "counter":
+            name = _prom_name(m["name"]) + "_total"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{labels} {m['value']}")
+            continue
+        name = _prom_name(m["name"]) + "_seconds"
+        if name not in typed:
+            lines.append(f"# TYPE {name} summary")
+            lines.append(f"# TYPE {name}_max gauge")
+            typed.add(name)
+        lines.append(f"{name}_count{labels} {m['count']}")
+        lines.append(f"{name}_sum{labels} {m['sum_s']}")
+        lines.append(f"{name}_max{labels} {m['max_s']}")
+    return "".join(line + "\n" for line in lines)
+
+
+def write(path, run=None):
+    """Write the registry: Prometheus text for *.prom, else append JSON lines."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    metrics = snapshot()
+    if path.suffix == ".prom":
+        # the textfile collector may read at any time: replace the file atomically
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(prometheus_text(metrics))
+        os.replace(tmp, path)
+        return
+    stamp = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    with open(path, "a") as f:
+        for m in metrics:
+            f.write(json.dumps(dict(run=run, time=stamp, **m)) + "\n")
+
+
+def run(main, *args):
+    """Entry point for the scripts: logging, optional profiling and metrics output."""
+    logging.basicConfig(level=LOG_LEVEL.upper(), format="%(message)s")
+    name = getattr(main, "__module__", None)
+    if name == "__main__":
+        import __main__
+        name = Path(getattr(__main__, "__file__", "main")).stem
+    profiler = None
+    if PROFILE_PATH:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with timer("script", script=name):
+            return main(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            Path(PROFILE_PATH).parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(PROFILE_PATH)
+        if METRICS_PATH:
+            write(METRICS_PATH, run=name)
@@ -0,0 +1,291 @@
+# -----------------------------------------------------------
+# End-to-end pipeline: complaints -> maps and hot blocks -> imagery -> bag counts -> 311
+# -----------------------------------------------------------
+# Each script is a stage with declared inputs and outputs. Before a stage runs, its
+# inputs, its script, the repo modules it uses and its arguments are fingerprinted; if the fingerprint matches the
+# one saved in data/pipeline/<stage>.json after its last successful run and its outputs
+# still exist, the stage is skipped. Stages start as soon as the ones they depend on
+# finish, so the two overview maps are rendered while the hot blocks are downloaded and
+# scored. CPU-bound stages run in worker processes.
+#
+# The clusters stage treats every hot block as its own work unit: CLUSTER_WORKERS blocks
+# are downloaded and scored at once over one shared Mapillary session, image store and
+# model cache. The stage runs every time and searches each block's bbox, so new imagery
+# is picked up; a block whose bbox and search result are unchanged since its last
+# complete run is skipped. With TILE_IMAGERY, a block's images come from the tile cache
+# (see imagery_tiles.py), so overlapping blocks share tiles and the cache's disk quota
+# bounds the imagery kept.
+#
+#   python pipeline.py                    # everything
+#   python pipeline.py maps               # only the listed stages and what they need
+#   python pipeline.py --force clusters   # re-run even if nothing changed
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections.abc import Callable
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
+from pathlib import Path
+import hashlib, inspect, json, multiprocessing, sys, time
+
+import batch_inference, complaints, download, find_clusters, find_top_clusters
+import metrics, report_311, visualize_reports
+import cell_bins, clustering, dedup_frames, hot_areas, hot_bboxes, image_store, imagery_tiles
+import incremental_clusters, inference_cache, map_layers, mapillary_client, sharded_clustering
+from hot_bboxes import HOT_BBOXES_PATH, read_hot_bboxes
+from image_store import ImageStore, write_atomic
+
+STATE_DIR       = Path("data/pipeline")
+STAGE_WORKERS   = 3                    # processes for CPU-bound stages
+CLUSTER_WORKERS = 3                    # hot blocks downloaded and scored at once
+TILE_IMAGERY    = False                # fetch hot block imagery through the tile cache
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable                      # module-level function, so a worker process can run it
+    inputs: tuple = ()                 # files or folders whose content decides re-runs
+    outputs: tuple = ()
+    after: tuple = ()                  # stages that must finish first
+    args: tuple = ()
+    in_process: bool = False           # I/O-bound: run on a thread of the pipeline process
+    modules: tuple = ()                # repo modules the script uses; their code decides re-runs
+    always: bool = False               # run every time; the stage skips its own up-to-date work
+
+
+def path_fingerprint(path) -> str:
+    """Content hash of a file; size and mtime of every file under a folder."""
+    path = Path(path)
+    if path.is_file():
+        return complaints.cached_digest(path)
+    if path.is_dir():
+        h = hashlib.sha256()
+        for p in sorted(path.rglob("*")):
+            if p.is_file():
+                st = p.stat()
+                h.update(f"{p.relative_to(path)}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+        return h.hexdigest()
+    return "missing"
+
+
+def source_fingerprint(modules) -> str:
+    """Hash of the source files of some modules."""
+    h = hashlib.sha256()
+    for module in modules:
+        h.update(f"{module.__name__}:{complaints.file_digest(inspect.getsourcefile(module))}\n".encode())
+    return h.hexdigest()
+
+
+def stage_fingerprint(stage) -> str:
+    """Hash of the stage's script, the modules it uses, its arguments and inputs."""
+    h = hashlib.sha256()
+    h.update(complaints.file_digest(inspect.getsourcefile(stage.run)).encode())
+    h.update(source_fingerprint(stage.modules).encode())
+    h.update(repr(stage.args).encode())
+    for path in stage.inputs:
+        h.update(f"{path}:{path_fingerprint(path)}\n".encode())
+    return h.hexdigest()
+
+
+def _stamp_path(name) -> Path:
+    return STATE_DIR / f"{name}.json"
+
+
+def is_fresh(stage, fingerprint) -> bool:
+    stamp = _stamp_path(stage.name)
+    if not stamp.exists() or json.loads(stamp.read_text())["fingerprint"] != fingerprint:
+        return False
+    return all(Path(p).exists() for p in stage.outputs)
+
+
+def save_stamp(name, fingerprint, seconds):
+    stamp = _stamp_path(name)
+    stamp.parent.mkdir(parents=True, exist_ok=True)
+    write_atomic(stamp, json.dumps({"fingerprint": fingerprint, "seconds": round(seconds, 3),
+                                    "finished": time.time()}))
+
+
+def select(stages, targets):
+    """The target stages plus everything they depend on, in pipeline order."""
+    by_name = {s.name: s for s in stages}
+    unknown = set(targets) - set(by_name)
+    if unknown:
+        raise ValueError(f"Unknown stages: {sorted(unknown)}")
+    needed, todo = set(), list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(by_name[name].after)
+    return [s for s in stages if s.name in needed]
+
+
+def run_stages(stages, force=False, workers=STAGE_WORKERS):
+    """Run stages as their dependencies finish; returns {stage: status}.
+
+    Status is "ran", "cached", "failed" or "blocked" (a dependency failed).
+    Stages must be listed after the stages they depend on.
+    """
+    futures = {}
+
+    def run(stage, procs):
+        if any(futures[dep].result() in ("failed", "blocked") for dep in stage.after):
+            print(f"[{stage.name}] blocked")
+            return "blocked"
+        fingerprint = stage_fingerprint(stage)
+        if not force and not stage.always and is_fresh(stage, fingerprint):
+            print(f"[{stage.name}] up to date")
+            return "cached"
+        print(f"[{stage.name}] running")
+        start = time.perf_counter()
+        try:
+            if stage.in_process:
+                stage.run(*stage.args)
+            else:
+                # a worker's timers and counters come back with its result
+                metrics.merge(procs.submit(metrics.collect, stage.run, *stage.args).result())
+        except Exception as e:
+            print(f"[{stage.name}] failed: {e!r}")
+            return "failed"
+        seconds = time.perf_counter() - start
+        metrics.observe("stage", seconds, stage=stage.name)
+        # fingerprint again: a stage may rewrite its own inputs (e.g. the complaints cache)
+        save_stamp(stage.name, stage_fingerprint(stage), seconds)
+        print(f"[{stage.name}] done in {seconds:.1f} s")
+        return "ran"
+
+    # spawn, not fork: the scheduler threads are already running
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=ctx) as procs, \
+            ThreadPoolExecutor(len(stages) or 1) as threads:
+        for stage in stages:
+            missing = [dep for dep in stage.after if dep not in futures]
+            if missing:
+                raise ValueError(f"{stage.name} listed before {missing}")
+            futures[stage.name] = threads.submit(run, stage, procs)
+        return {name: future.result() for name, future in futures.items()}
+
+
+# --- clusters as parallel work units ---------------------------------------------
+
+# code that decides what a cluster unit downloads and how it is scored
+UNIT_MODULES = (download, batch_inference, dedup_frames, imagery_tiles)
+
+
+def _unit_fingerprint(bb, images) -> str:
+    # the image ids found in the bbox, so new imagery there re-runs the unit
+    key = [bb["cid"], bb["west"], bb["south"], bb["east"], bb["north"],
+           sorted(str(img["id"]) for img in images),
+           download.TEST_MODE, batch_inference.model_id(), source_fingerprint(UNIT_MODULES)]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def process_cluster(bb, client, store, pool, model, force=False, tiles=None) -> str:
+    """Download one hot block's images and score them; returns "ran" or "cached".
+
+    With a TileCache, the images are served from (or fetched into) its tiles.
+    """
+    name = f"clusters/{bb['cid']}"
+    start = time.perf_counter()
+    # with a TileCache, the block's tiles stay pinned until its images are scored
+    hold = nullcontext() if tiles is None else tiles.pin(imagery_tiles.tiles_in_bbox(bb))
+    with hold:
+        found = download.search_cluster(bb, client) if tiles is None else tiles.images_in_bbox(bb)
+        fingerprint = _unit_fingerprint(bb, found)
+        if not force and _stamp_path(name).exists() \
+                and json.loads(_stamp_path(name).read_text())["fingerprint"] == fingerprint:
+            print(f"[{name}] up to date")
+            return "cached"
+
+        cluster = str(bb["cid"])
+        if tiles is None:
+            saved, failed = download.download_cluster(bb, client, store, pool, found)
+            # only this bbox's images: the cluster folder can still hold those of an older
+            # block that had the same cluster id
+            block_dir = download.OUT_DIR / f"cluster_{cluster}"
+            images = [(cluster, image_id, block_dir / f"{image_id}.jpg") for image_id in saved]
+        else:
+            # failed tile images are logged and retried on the next request
+            images, failed = [(cluster, str(img["id"]), Path(img["path"])) for img in found], 0
+        todo = batch_inference.pending_images(images, clusters={cluster})
+        failed += len(todo) - batch_inference.run_batch(todo, model)
+        if failed:
+            raise RuntimeError(
+                f"{failed} images of cluster {cluster} were not downloaded or scored")
+        save_stamp(name, fingerprint, time.perf_counter() - start)
+        return "ran"
+
+
+def _tile_cache(client):
+    """TileCache for the hot blocks if TILE_IMAGERY is set, else a context yielding None."""
+    if not TILE_IMAGERY:
+        return nullcontext()
+    # hot blocks are not panned around, so no neighbor prefetch
+    return imagery_tiles.TileCache(client, prefetch_ring=0)
+
+
+def process_clusters(force=False, workers=CLUSTER_WORKERS):
+    """Download and score every published hot block, several blocks at a time."""
+    from inference_cache import InferenceCache
+    from mapillary_client import MapillaryClient
+
+    bboxes = list(read_hot_bboxes(follow=False))
+    with MapillaryClient(download.get_token()) as client, ImageStore() as store, \
+            InferenceCache() as cache, \
+            ThreadPoolExecutor(download.MAX_WORKERS) as pool, \
+            _tile_cache(client) as tiles, \
+            ThreadPoolExecutor(workers) as units:
+        model = batch_inference.get_model(cache)
+        futures = {bb["cid"]: units.submit(process_cluster, bb, client, store, pool, model, force, tiles)
+                   for bb in bboxes}
+        failed = []
+        for cid, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"[clusters/{cid}] failed: {e}")
+                failed.append(cid)
+    if failed:
+        raise RuntimeError(f"clusters {failed} failed")
+
+
+STAGES = [
+    Stage("complaints", complaints.build_cache, inputs=(complaints.CSV_PATH,),
+          outputs=(complaints.CACHE_DIR,)),
+    # DBSCAN labels shared by the three maps (see clustering.cached_labels)
+    Stage("labels", clustering.cached_labels, inputs=(complaints.CACHE_DIR,),
+          after=("complaints",), modules=(complaints,)),
+    Stage("overview_map", visualize_reports.main, inputs=(complaints.CACHE_DIR,),
+          outputs=(visualize_reports.MAP_HTML, visualize_reports.HOT_AREAS_PATH),
+          after=("labels",), modules=(complaints, clustering, hot_areas, map_layers)),
+    Stage("cluster_map", find_clusters.main, inputs=(complaints.CACHE_DIR,),
+          outputs=(find_clusters.MAP_HTML,), after=("labels",),
+          modules=(complaints, clustering, sharded_clustering, map_layers)),
+    Stage("hot_blocks", find_top_clusters.main, inputs=(complaints.CACHE_DIR,),
+          outputs=(HOT_BBOXES_PATH, find_top_clusters.MAP_HTML), after=("labels",),
+          modules=(complaints, clustering, sharded_clustering, hot_areas, incremental_clusters,
+                   map_layers, cell_bins, hot_bboxes)),
+    Stage("clusters", process_clusters, inputs=(HOT_BBOXES_PATH,),
+          outputs=(batch_inference.RESULTS_PATH,), after=("hot_blocks",), in_process=True,
+          modules=(download, batch_inference, hot_bboxes, image_store, imagery_tiles,
+                   mapillary_client, dedup_frames, inference_cache), always=True),
+    Stage("report", report_311.main, inputs=(batch_inference.RESULTS_PATH,),
+          outputs=(report_311.OUTBOX_PATH,), after=("clusters",), in_process=True,
+          modules=(cell_bins,)),
+]
+
+# named groups for the command line
+TARGETS = {"maps": ("overview_map", "cluster_map", "hot_blocks")}
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    force = "--force" in argv
+    targets = [t for arg in argv if arg != "--force" for t in TARGETS.get(arg, (arg,))]
+    stages = select(STAGES, targets) if targets else STAGES
+    if force:
+        # the clusters stage re-runs its units too
+        stages = [replace(s, args=(True,)) if s.run is process_clusters else s for s in stages]
+    status = metrics.run(run_stages, stages, force)
+    print(", ".join(f"{name}={s}" for name, s in status.items()))
+    sys.exit(any(s in ("failed", "blocked") for s in status.values()))
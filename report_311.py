@@ -0,0 +1,243 @@
+# -----------------------------------------------------------
+# 4.  Turn inference results into 311 requests
+# -----------------------------------------------------------
+# When the model counts more than MIN_BAGS trash bags, a 311 request should be filed.
+# Every Mapillary frame of a pile sees the same bags, so results from
+# data/inference/results.jsonl are first aggregated per location and capture window:
+# frames in the same PILE_CELL_FT square cell (see cell_bins.py) and WINDOW_HOURS of
+# capturedAt are one pile, and one pile gives one request, located at the frame with
+# the highest count. A frame scored for several overlapping hot blocks counts once, and
+# a frame without capturedAt is a pile of its own. Each request has an id derived from
+# (cell, window), or (cell, image id) for such a frame, which stays the same when the
+# clusters are renumbered, so re-running only appends requests that are not yet in
+# data/311/outbox.jsonl.
+#
+# Pending requests are submitted in batches of BATCH_SIZE through a pluggable client.
+# Open311Client posts a batch's requests to a GeoReport v2 endpoint (OPEN311_URL,
+# OPEN311_API_KEY) concurrently over one pooled keep-alive session, and
+# StubClient records submissions locally for tests and dry runs. Accepted ids are
+# appended to data/311/submitted.jsonl and are never sent twice.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib, json, logging, os, re
+
+import numpy as np
+from pyproj import Transformer
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from cell_bins import square_cells
+
+RESULTS_PATH   = Path("data/inference/results.jsonl")
+OUTBOX_PATH    = Path("data/311/outbox.jsonl")
+SUBMITTED_PATH = Path("data/311/submitted.jsonl")
+STUB_PATH      = Path("data/311/stub_submissions.jsonl")
+
+MIN_BAGS     = 3                       # file a request above this many bags
+WINDOW_HOURS = 24
+PILE_CELL_FT = 100                     # frames in one cell and window are one pile
+BATCH_SIZE   = 20
+SUBMIT_WORKERS = 8                     # requests of a batch posted at once
+
+SERVICE_CODE = "Obstruction"           # 311 complaint type the source data uses
+DESCRIPTOR   = "Trash or Recycling"
+
+log = logging.getLogger(__name__)
+
+
+def read_jsonl(path):
+    path = Path(path)
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def bag_count(result) -> int:
+    """Bags in one frame: the number in the model's answer, else the detected boxes."""
+    match = re.search(r"\d+", str(result.get("answer", "")))
+    return int(match.group()) if match else int(result.get("boxes", 0))
+
+
+def frame_meta(result) -> dict:
+    """Metadata download.py saved next to the scored image, or {}."""
+    meta_path = Path(result["path"]).with_suffix(".json")
+    return json.loads(meta_path.read_text()) if meta_path.exists() else {}
+
+
+def request_id(cell, window, image_id=None) -> str:
+    """Id of the pile in a cell and capture window, or of one frame without a capture time."""
+    key = f"cell:{cell}:{window}" if image_id is None else f"cell:{cell}:image:{image_id}"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def pile_cells(metas, cell_ft=PILE_CELL_FT):
+    """Square cell id of each frame's location (State Plane ft), None without one."""
+    located = [i for i, m in enumerate(metas) if m.get("lat") is not None and m.get("lon") is not None]
+    cells = [None] * len(metas)
+    if located:
+        to_ft = Transformer.from_crs("EPSG:4326", "EPSG:2263", always_xy=True)
+        x, y = to_ft.transform([metas[i]["lon"] for i in located], [metas[i]["lat"] for i in located])
+        for i, cell in zip(located, square_cells(np.column_stack([x, y]), cell_ft)):
+            cells[i] = int(cell)
+    return cells
+
+
+def aggregate(results, min_bags=MIN_BAGS, window_hours=WINDOW_HOURS, cell_ft=PILE_CELL_FT):
+    """One request per (cell, capture window) whose busiest frame shows > min_bags bags.
+
+    Frames without a saved location cannot be filed and are left out. A frame
+    without a capture time cannot be grouped, so it is a pile of its own.
+    """
+    window_ms = window_hours * 3_600_000
+    frames, clusters = {}, {}
+    for r in results:
+        frames.setdefault(str(r["image_id"]), r)  # one frame in several hot blocks counts once
+        clusters.setdefault(str(r["image_id"]), set()).add(str(r["cluster"]))
+    frames = list(frames.values())
+    metas = [frame_meta(r) for r in frames]
+
+    piles = {}
+    for r, meta, cell in zip(frames, metas, pile_cells(metas, cell_ft)):
+        if cell is None:
+            continue
+        captured = meta.get("capturedAt")
+        if captured is not None:
+            key = (cell, int(captured // window_ms), "")
+        else:
+            key = (cell, -1, str(r["image_id"]))
+        count = bag_count(r)
+        pile = piles.setdefault(key, {"bags": -1, "frames": [], "clusters": set()})
+        pile["frames"].append(str(r["image_id"]))
+        pile["clusters"] |= clusters[str(r["image_id"])]
+        if count > pile["bags"]:
+            pile.update(bags=count, best=r["image_id"], meta=meta)
+
+    out = []
+    for (cell, window, frame), pile in sorted(piles.items()):
+        if pile["bags"] <= min_bags:
+            continue
+        meta = pile["meta"]
+        out.append({
+            "request_id": request_id(cell, window, frame or None),
+            "cell": cell,
+            "clusters": sorted(pile["clusters"]),
+            "window_start_ms": window * window_ms if window >= 0 else None,
+            "bags": pile["bags"],
+            "image_id": pile["best"],
+            "frames": sorted(pile["frames"]),
+            "lat": meta.get("lat"),
+            "lon": meta.get("lon"),
+            "service_code": SERVICE_CODE,
+            "description": f"{DESCRIPTOR}: about {pile['bags']} trash bags on the sidewalk "
+                           f"(Mapillary image {pile['best']})",
+        })
+    return out
+
+
+def append_outbox(reqs, outbox=OUTBOX_PATH):
+    """Append requests whose id is not in the outbox yet; returns the ones added."""
+    outbox = Path(outbox)
+    outbox.parent.mkdir(parents=True, exist_ok=True)
+    known = {r["request_id"] for r in read_jsonl(outbox)}
+    new = [r for r in reqs if r["request_id"] not in known]
+    with open(outbox, "a") as f:
+        for r in new:
+            f.write(json.dumps(r) + "\n")
+    return new
+
+
+class StubClient:
+    """Accepts every request and records it in a local JSONL file."""
+
+    def __init__(self, path=STUB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def submit_batch(self, batch):
+        with open(self.path, "a") as f:
+            for r in batch:
+                f.write(json.dumps(r) + "\n")
+        return {r["request_id"]: f"stub-{r['request_id']}" for r in batch}
+
+
+class Open311Client:
+    """Posts requests to an Open311 GeoReport v2 endpoint over one pooled keep-alive session."""
+
+    def __init__(self, url, api_key, timeout=30, workers=SUBMIT_WORKERS):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def submit(self, r):
+        """Post one request; returns its ticket, or None if it was not accepted."""
+        try:
+            resp = self.session.post(f"{self.url}/requests.json", timeout=self.timeout, data={
+                "api_key": self.api_key,
+                "service_code": r["service_code"],
+                "lat": r["lat"],
+                "long": r["lon"],
+                "description": r["description"],
+            })
+            resp.raise_for_status()
+            body = resp.json()
+        except requests.RequestException as e:
+            log.warning(f" ! Failed to submit {r['request_id']}: {e}")
+            metrics.count("open311_submit", result="failed")
+            return None
+        ticket = body[0] if isinstance(body, list) else body
+        metrics.count("open311_submit", result="accepted")
+        return ticket.get("service_request_id") or ticket.get("token")
+
+    def submit_batch(self, batch):
+        """Post a batch's requests concurrently; returns {request_id: ticket} of the accepted ones."""
+        if not batch:
+            return {}
+        with ThreadPoolExecutor(min(len(batch), self.workers)) as pool:
+            tickets = list(pool.map(self.submit, batch))
+        return {r["request_id"]: t for r, t in zip(batch, tickets) if t is not None}
+
+
+def submit_pending(client, outbox=OUTBOX_PATH, submitted=SUBMITTED_PATH, batch_size=BATCH_SIZE):
+    """Submit outbox requests that were never accepted; returns how many were accepted."""
+    submitted = Path(submitted)
+    submitted.parent.mkdir(parents=True, exist_ok=True)
+    done = {r["request_id"] for r in read_jsonl(submitted)}
+    pending = [r for r in read_jsonl(outbox) if r["request_id"] not in done]
+
+    accepted = 0
+    with open(submitted, "a") as done_file:
+        for i in range(0, len(pending), batch_size):
+            tickets = client.submit_batch(pending[i:i + batch_size])
+            for rid, ticket in tickets.items():
+                done_file.write(json.dumps({"request_id": rid, "ticket": ticket}) + "\n")
+            done_file.flush()
+            accepted += len(tickets)
+    return accepted
+
+
+def get_client():
+    """Open311Client if OPEN311_URL is set, else the local stub."""
+    url = os.getenv("OPEN311_URL")
+    if url:
+        return Open311Client(url, os.getenv("OPEN311_API_KEY"))
+    return StubClient()
+
+
+def main():
+    reqs = aggregate(read_jsonl(RESULTS_PATH))
+    new = append_outbox(reqs)
+    print(f"{len(reqs)} piles above {MIN_BAGS} bags, {len(new)} new in {OUTBOX_PATH}")
+    n = submit_pending(get_client())
+    print(f"✅  Submitted {n} requests")
+
+
+if __name__ == "__main__":
+    metrics.run(main)
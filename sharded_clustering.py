@@ -0,0 +1,265 @@
+# -----------------------------------------------------------
+# DBSCAN sharded by spatial tile, on many cores or many machines
+# -----------------------------------------------------------
+# Complaints more than eps apart never affect each other's labels, so the city can be
+# clustered tile by tile. Points are split into square tiles of TILE_FT; each shard
+# holds the points a tile owns plus a halo of every point within eps of the tile.
+# A shard finds the core points it owns, joins them within the tile and reports the
+# links it cannot decide alone: core points joined to halo points, and border points
+# next to halo points. Whether a halo point is core is only known to the shard that
+# owns it, so those links are settled when the shards are stitched together.
+#
+# Stitching uses the same union-find as clustering.py: every set is rooted at its
+# smallest point index, so the labels match dbscan_labels() (and sklearn) exactly,
+# whatever order the shards finish in.
+#
+# Shards run in a process pool, or through a work queue folder shared by several
+# machines (CLUSTER_QUEUE, e.g. an NFS mount): the coordinator writes one file per
+# shard to <queue>/<run>/todo/, every worker claims files by renaming them and writes
+# its result to done/. Start extra workers on other machines with
+#
+#   CLUSTER_QUEUE=/mnt/queue python sharded_clustering.py [--follow]
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import logging, multiprocessing, os, shutil, socket, sys, time, uuid
+
+import numpy as np
+
+import metrics
+from clustering import (CHUNK_SIZE, EPS_FT, MIN_SAMPLES, GridIndex, _cell_keys, _chunks, _find,
+                        _union, join_cores, label_cores, neighbor_counts)
+
+TILE_FT       = 5000                   # side of a shard's tile; ~1 mile
+QUEUE_DIR     = os.getenv("CLUSTER_QUEUE")
+CLAIM_TIMEOUT = 600                    # s before a claimed shard is handed out again
+POLL_SEC      = 0.5
+
+_REACH = 1 + 1e-6                      # halo slightly wider than eps: rounding never drops a neighbor
+
+log = logging.getLogger(__name__)
+
+
+def tile_keys(xy, tile_ft=TILE_FT):
+    ij = np.floor(np.asarray(xy, dtype=np.float64) / tile_ft).astype(np.int64)
+    return _cell_keys(ij[:, 0], ij[:, 1])
+
+
+def partition(xy, eps=EPS_FT, tile_ft=TILE_FT):
+    """[(point indices, owned mask)] per non-empty tile, in tile order.
+
+    Indices are ascending; the rest of each shard is the halo within eps of the tile.
+    tile_ft must be at least eps, so a point's halo tiles are all within one tile of it.
+    """
+    reach = eps * _REACH
+    if tile_ft < reach:
+        raise ValueError(f"tile_ft ({tile_ft}) must be larger than eps ({eps})")
+    xy = np.asarray(xy, dtype=np.float64)
+    if not len(xy):
+        return []
+    own = tile_keys(xy, tile_ft)
+    points = np.arange(len(xy))
+    keys, members = [own], [points]
+    for dx in (-reach, 0, reach):
+        for dy in (-reach, 0, reach):
+            if not (dx or dy):
+                continue
+            k = tile_keys(xy + (dx, dy), tile_ft)
+            halo = k != own
+            keys.append(k[halo])
+            members.append(points[halo])
+    keys, members = np.concatenate(keys), np.concatenate(members)
+    order = np.lexsort((members, keys))
+    keys, members = keys[order], members[order]
+    first = np.r_[True, (keys[1:] != keys[:-1]) | (members[1:] != members[:-1])]
+    keys, members = keys[first], members[first]
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    shards = []
+    for key, idx in zip(keys[starts], np.split(members, starts[1:])):
+        owned = own[idx] == key
+        if owned.any():
+            shards.append((idx, owned))
+    return shards
+
+
+def cluster_shard(xy, idx, owned, eps=EPS_FT, min_samples=MIN_SAMPLES, chunk_size=CHUNK_SIZE):
+    """Cluster one shard; returns its part of the stitching input, in global indices.
+
+    cores/roots:   owned core points and the smallest core point each is joined to in the tile
+    links_a/_b:    owned core point, halo point within eps (joined if the halo point is core)
+    border_p/_q:   owned non-core point, neighbor that may be core (its label candidates)
+    """
+    index = GridIndex(xy, eps)
+    n = len(index.xy)
+    is_core = np.zeros(n, dtype=bool)
+    mine = index.cell_order(owned)
+    is_core[mine] = neighbor_counts(index, mine, eps, chunk_size) >= min_samples
+    cores = index.cell_order(is_core)
+
+    parent = np.arange(n)
+    join_cores(index, parent, is_core, cores, eps, chunk_size)
+    halo_idx = np.flatnonzero(~owned)
+    halo = GridIndex(index.xy[halo_idx], eps)
+    links_a, links_b = [], []
+    for chunk in _chunks(cores, chunk_size, halo.candidates(index.xy[cores])):
+        q, p = halo.pairs(index.xy[chunk], eps)
+        links_a.append(idx[chunk[q]])
+        links_b.append(idx[halo_idx[p]])
+
+    border_p, border_q = [], []
+    for chunk in index.chunks(index.cell_order(owned & ~is_core), chunk_size):
+        q, p = index.pairs(index.xy[chunk], eps)
+        keep = is_core[p] | ~owned[p]
+        border_p.append(idx[chunk[q[keep]]])
+        border_q.append(idx[p[keep]])
+
+    # local indices follow the global order, so local roots are the smallest global ones
+    core_idx = np.flatnonzero(is_core)
+    none = np.empty(0, np.int64)
+    return dict(cores=idx[core_idx], roots=idx[_find(parent, core_idx)],
+                links_a=np.concatenate(links_a or [none]), links_b=np.concatenate(links_b or [none]),
+                border_p=np.concatenate(border_p or [none]), border_q=np.concatenate(border_q or [none]))
+
+
+def stitch(n, results):
+    """DBSCAN labels of all n points from every shard's cluster_shard() output."""
+    is_core = np.zeros(n, dtype=bool)
+    parent = np.arange(n)
+    for r in results:
+        is_core[r["cores"]] = True
+        parent[r["cores"]] = r["roots"]
+    a = np.concatenate([r["links_a"] for r in results] or [np.empty(0, np.int64)])
+    b = np.concatenate([r["links_b"] for r in results] or [np.empty(0, np.int64)])
+    keep = is_core[b]
+    _union(parent, a[keep], b[keep])
+    labels = label_cores(parent, is_core)
+
+    p = np.concatenate([r["border_p"] for r in results] or [np.empty(0, np.int64)])
+    q = np.concatenate([r["border_q"] for r in results] or [np.empty(0, np.int64)])
+    keep = is_core[q]
+    best = np.full(n, np.iinfo(np.int64).max)
+    np.minimum.at(best, p[keep], labels[q[keep]])
+    hit = best != np.iinfo(np.int64).max
+    labels[hit] = best[hit]
+    return labels
+
+
+def dbscan_sharded(xy, eps=EPS_FT, min_samples=MIN_SAMPLES, tile_ft=TILE_FT, n_jobs=None,
+                   queue_dir=QUEUE_DIR):
+    """Same labels as clustering.dbscan_labels(xy, eps, min_samples), clustered per tile.
+
+    tile_ft must be larger than eps (see partition).
+
+    Shards go to a pool of n_jobs processes (default: all cores), or through queue_dir
+    when it is set, where workers on other machines can pick them up too.
+    """
+    xy = np.ascontiguousarray(xy, dtype=np.float64)
+    with metrics.timer("dbscan_sharded"):
+        shards = partition(xy, eps, tile_ft)
+        metrics.count("dbscan_shards", len(shards))
+        jobs = [(xy[idx], idx, owned, eps, min_samples) for idx, owned in shards]
+        if queue_dir:
+            results = run_queue(jobs, queue_dir, n_jobs)
+        else:
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(n_jobs or os.cpu_count(), mp_context=ctx) as pool:
+                results = list(pool.map(cluster_shard, *zip(*jobs), chunksize=4)) if jobs else []
+        labels = stitch(len(xy), results)
+    metrics.count("dbscan_points", len(xy))
+    return labels
+
+
+# ---- file-based work queue ---------------------------------------------------
+
+def _save(path, **arrays):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def run_queue(jobs, queue_dir, n_jobs=None):
+    """Publish jobs under queue_dir, work on them locally and collect every result."""
+    run = Path(queue_dir) / f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    for sub in ("todo", "claimed", "done"):
+        (run / sub).mkdir(parents=True, exist_ok=True)
+    for k, (xy, idx, owned, eps, min_samples) in enumerate(jobs):
+        _save(run / "todo" / f"{k:06d}.npz", xy=xy, idx=idx, owned=owned, eps=eps,
+              min_samples=min_samples)
+    print(f"Queued {len(jobs)} shards in {run}")
+
+    ctx = multiprocessing.get_context("spawn")
+    names = [f"{k:06d}.npz" for k in range(len(jobs))]
+    with ProcessPoolExecutor(n_jobs or os.cpu_count(), mp_context=ctx) as pool:
+        workers = [pool.submit(work, run.parent) for _ in range(n_jobs or os.cpu_count())]
+        while not all((run / "done" / name).exists() for name in names):
+            for w in workers:
+                if w.done():
+                    w.result()                      # re-raise a local worker's error
+            requeue_stale(run)
+            if all(w.done() for w in workers) and any((run / "todo").iterdir()):
+                workers.append(pool.submit(work, run.parent))  # shards put back after a timeout
+            time.sleep(POLL_SEC)
+
+    results = []
+    for name in names:
+        with np.load(run / "done" / name) as data:
+            results.append({key: data[key] for key in data.files})
+    shutil.rmtree(run, ignore_errors=True)
+    return results
+
+
+def requeue_stale(run, timeout=CLAIM_TIMEOUT):
+    """Put back shards claimed longer than timeout ago by a worker that went away."""
+    for path in (run / "claimed").glob("*.npz"):
+        try:
+            if time.time() - path.stat().st_mtime > timeout:
+                os.rename(path, run / "todo" / path.name)
+        except FileNotFoundError:
+            pass                                    # finished meanwhile
+
+
+def _claim(queue_dir):
+    """Take one pending shard of any run, or None."""
+    for todo in sorted(Path(queue_dir).glob("*/todo/*.npz")):
+        claimed = todo.parent.parent / "claimed" / todo.name
+        try:
+            os.rename(todo, claimed)                # atomic: only one worker wins
+        except FileNotFoundError:
+            continue
+        os.utime(claimed)                           # the claim time, for requeue_stale
+        return claimed
+    return None
+
+
+def work(queue_dir, follow=False):
+    """Cluster queued shards until none are left (or forever with follow)."""
+    done = 0
+    while True:
+        claimed = _claim(queue_dir)
+        if claimed is None:
+            if not follow:
+                return done
+            time.sleep(POLL_SEC)
+            continue
+        with np.load(claimed) as job:
+            result = cluster_shard(job["xy"], job["idx"], job["owned"], float(job["eps"]),
+                                   int(job["min_samples"]))
+        out = claimed.parent.parent / "done" / claimed.name
+        if out.parent.exists():                     # the run may have been collected already
+            _save(out, **result)
+        claimed.unlink(missing_ok=True)
+        log.debug(f"Clustered shard {claimed.parent.parent.name}/{claimed.name}")
+        done += 1
+
+
+def main(follow=False):
+    if not QUEUE_DIR:
+        sys.exit("Set CLUSTER_QUEUE to the shared queue folder")
+    print(f"Worker {socket.gethostname()}:{os.getpid()} on {QUEUE_DIR}")
+    print(f"✅  {work(QUEUE_DIR, follow)} shards clustered")
+
+
+if __name__ == "__main__":
+    metrics.run(main, "--follow" in sys.argv[1:])
@@ -1,15 +1,238 @@
+# -----------------------------------------------------------
+# Live trash monitor on a webcam (or a recorded video)
+# -----------------------------------------------------------
+# A capture thread reads frames as fast as the camera delivers them and keeps only the
+# newest one. The main loop scores how much the scene changed since the last sampled
+# frame; when it moved enough (or MAX_SAMPLE_SEC passed), the frame is downscaled and
+# handed to the trash-bag detector running on its own thread. The detector holds at most
+# one pending frame: a newer sample replaces it, so stale frames are dropped instead of
+# queued and capture never waits on the model. Every REPORT_SEC the loop prints capture
+# and inference frames/sec and the end-to-end latency from capture to detection.
+#
+#   python use_webcam.py                  # /dev/video0
+#   python use_webcam.py street.mp4       # recorded video, played back in real time
+
+from pathlib import Path
+import os, sys, threading, time
+
 import cv2
+from PIL import Image
+
+import metrics
+
+SOURCE       = "0"                     # camera index or video file; overridden by argv[1]
+FRAME_WIDTH  = 1920
+FRAME_HEIGHT = 1080
+SHOW_PREVIEW = os.getenv("DISPLAY") is not None
+
+INFER_SIDE       = 768                 # longer side of frames sent to the model
+MOTION_SIDE      = 64                  # longer side of the grayscale motion thumbnail
+MOTION_THRESHOLD = 6.0                 # mean abs gray-level change that triggers a sample
+MAX_SAMPLE_SEC   = 10.0                # sample at least this often, even in a still scene
+REPORT_SEC       = 5.0
+
+DETECT_PROMPT = "trash bags"
+
+
+def open_capture(source):
+    """cv2.VideoCapture for a camera index ("0") or a video file path."""
+    if str(source).isdigit():
+        cap = cv2.VideoCapture(int(source))    # 0 = /dev/video0
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+        return cap, False
+    if not Path(source).exists():
+        raise FileNotFoundError(source)
+    return cv2.VideoCapture(str(source)), True
+
+
+def shrink(frame, side):
+    """Resize a frame so its longer side is `side` pixels (never upscales)."""
+    h, w = frame.shape[:2]
+    scale = side / max(h, w)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+def motion_thumb(frame):
+    return cv2.cvtColor(shrink(frame, MOTION_SIDE), cv2.COLOR_BGR2GRAY)
+
+
+def motion_score(prev, thumb):
+    """Mean absolute gray-level difference between two motion thumbnails (0-255)."""
+    return float(cv2.absdiff(prev, thumb).mean())
+
+
+class FrameGrabber(threading.Thread):
+    """Reads frames continuously and keeps only the newest one."""
+
+    def __init__(self, cap, realtime=False):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.realtime = realtime              # pace video files at their own fps
+        self.fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.cond = threading.Condition()
+        self.latest = None                    # (frame index, capture time, frame)
+        self.count = 0
+        self.done = False
+        self.stopped = False
+
+    def stop(self):
+        """Ask the thread to finish after the read in progress; join() before cap.release()."""
+        self.stopped = True
+
+    def run(self):
+        start = time.perf_counter()
+        while not self.stopped:
+            ok, frame = self.cap.read()
+            if not ok:
+                break
+            if self.realtime:
+                delay = start + self.count / self.fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            with self.cond:
+                self.latest = (self.count, time.perf_counter(), frame)
+                self.count += 1
+                self.cond.notify_all()
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def next_frame(self, after, timeout=1.0):
+        """Newest frame with an index greater than `after`, or None once capture ended."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.done or (self.latest and self.latest[0] > after),
+                               timeout=timeout)
+            if self.latest and self.latest[0] > after:
+                return self.latest
+            return None
+
+
+class AsyncDetector(threading.Thread):
+    """Runs detect_fn on the most recent submitted frame; older pending frames are dropped."""
+
+    def __init__(self, detect_fn):
+        super().__init__(daemon=True)
+        self.detect_fn = detect_fn
+        self.cond = threading.Condition()
+        self.pending = None                   # (capture time, frame)
+        self.stopped = False
+        self.results = []                     # (capture time, finish time, bag count)
+        self.dropped = 0
+
+    def submit(self, captured_at, frame):
+        with self.cond:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = (captured_at, frame)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopped or self.pending is not None)
+                if self.pending is None:
+                    return
+                captured_at, frame = self.pending
+                self.pending = None
+            try:
+                bags = self.detect_fn(frame)
+            except Exception as e:
+                print(f" ! detection failed: {e}")
+                continue
+            with self.cond:
+                self.results.append((captured_at, time.perf_counter(), bags))
+
+
+def model_detector():
+    """Count trash bags in a BGR frame with Moondream (see batch_inference.get_model)."""
+    from batch_inference import get_model
+    model = get_model()
+
+    def detect(frame):
+        img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        with metrics.timer("model_call", call="detect"):
+            return len(model.detect(img, DETECT_PROMPT)["objects"])
+    return detect
+
+
+def monitor(source=SOURCE, detect_fn=None, show=SHOW_PREVIEW, duration=None):
+    """Run the live monitor until the video ends, ESC is pressed or duration passes.
+
+    Returns a summary: frames captured, frames sampled, inferences, dropped
+    samples, capture/inference fps and mean/max end-to-end latency.
+    """
+    cap, is_file = open_capture(source)
+    grabber = FrameGrabber(cap, realtime=is_file)
+    detector = AsyncDetector(detect_fn or model_detector())
+    grabber.start()
+    detector.start()
+
+    start = last_report = time.perf_counter()
+    last_index, last_thumb, last_sample = -1, None, 0.0
+    sampled, reported = 0, 0
+    try:
+        while duration is None or time.perf_counter() - start < duration:
+            got = grabber.next_frame(last_index)
+            if got is None:
+                if grabber.done:
+                    break
+                continue
+            last_index, captured_at, frame = got
+
+            thumb = motion_thumb(frame)
+            now = time.perf_counter()
+            if (last_thumb is None or now - last_sample >= MAX_SAMPLE_SEC
+                    or motion_score(last_thumb, thumb) >= MOTION_THRESHOLD):
+                detector.submit(captured_at, shrink(frame, INFER_SIDE))
+                last_thumb, last_sample = thumb, now
+                sampled += 1
+
+            if show:
+                cv2.imshow("C960 preview", frame)
+                if cv2.waitKey(1) & 0xFF == 27:    # ESC to quit
+                    break
+
+            if now - last_report >= REPORT_SEC:
+                new = detector.results[reported:]
+                reported += len(new)
+                latency = [done - cap_t for cap_t, done, _ in new]
+                print(f"capture {grabber.count / (now - start):5.1f} fps | "
+                      f"inference {len(new) / (now - last_report):4.2f} fps | "
+                      f"latency {sum(latency) / len(latency) if latency else 0:5.2f} s | "
+                      f"bags {new[-1][2] if new else '-'}")
+                last_report = now
+    finally:
+        detector.stop()
+        grabber.stop()
+        detector.join()
+        grabber.join()                         # never release the camera under a pending read
+        cap.release()
+        if show:
+            cv2.destroyAllWindows()
 
-cap = cv2.VideoCapture(0)              # 0 = /dev/video0
-cap.set(cv2.CAP_PROP_FRAME_WIDTH,1920)
-cap.set(cv2.CAP_PROP_FRAME_HEIGHT,1080)
+    elapsed = time.perf_counter() - start
+    latency = [done - cap_t for cap_t, done, _ in detector.results]
+    return {
+        "frames": grabber.count,
+        "sampled": sampled,
+        "inferences": len(detector.results),
+        "dropped": detector.dropped,
+        "capture_fps": grabber.count / elapsed,
+        "inference_fps": len(detector.results) / elapsed,
+        "latency_mean_s": sum(latency) / len(latency) if latency else None,
+        "latency_max_s": max(latency) if latency else None,
+    }
 
-while True:
-    ok, frame = cap.read()
-    if not ok: break
-    cv2.imshow("C960 preview", frame)
-    if cv2.waitKey(1) & 0xFF == 27:    # ESC to quit
-        break
 
-cap.release()
-cv2.destroyAllWindows()
+if __name__ == "__main__":
+    summary = metrics.run(monitor, sys.argv[1] if len(sys.argv) > 1 else SOURCE)
+    print(", ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}"
+                    for k, v in summary.items()))
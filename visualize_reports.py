@@ -1,63 +1,94 @@
-# This script analyzes NYC 311 service requests for sidewalk blockages by creating a buffer
-# around each complaint location and finding their union. It generates a bounding box around
-# all buffered points to identify the overall area affected by sidewalk issues, then
-# visualizes this on an interactive map along with sample complaint locations.
+# This script analyzes NYC 311 service requests for sidewalk blockages by drawing a buffer
+# around each complaint location. It computes the bounding box of all buffered points to
+# identify the overall area affected by sidewalk issues, and the hot areas inside it: the
+# buffered footprint of every DBSCAN cluster, saved to data/hot_areas.geojson. Both are
+# visualized on an interactive map along with sample complaint locations.
+# Envelopes come straight from the coordinate arrays and footprints are unioned per
+# cluster (see hot_areas.py), so this scales to citywide data.
 
-import pandas as pd, geopandas as gpd
-from shapely.geometry import Point
+from pathlib import Path
+import geopandas as gpd
 import folium
+import numpy as np
 from shapely.geometry import box
+import metrics
+from complaints import load_complaints
+from clustering import cached_labels
+from hot_areas import BUFFER_FT, cluster_footprints, envelope_bounds
+from map_layers import add_points
 
-# Load the 311 service requests data
-df = pd.read_csv('311_Service_Requests_from_2010_to_Present_20250621.csv')
-
-# Filter out rows with missing coordinates
-df = df.dropna(subset=['Longitude', 'Latitude'])
-
-gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.Longitude, df.Latitude), crs="EPSG:4326")
-hot = gdf.to_crs(2263).buffer(25).union_all()  # 25 m buffer - using union_all() instead of unary_union
-hot_bounds = hot.envelope.bounds  # minx, miny, maxx, maxy
-print(hot_bounds)
-print('end of clustering')
-
-# Visualization: Create a map showing the bounding box
-# Convert the bounding box back to WGS84 for mapping
-bbox_geom = box(*hot_bounds)  # Create rectangle from bounds
-bbox_gdf = gpd.GeoDataFrame([1], geometry=[bbox_geom], crs="EPSG:2263")
-bbox_wgs84 = bbox_gdf.to_crs("EPSG:4326")  # Convert to WGS84
-
-# Get the center point for the map
-center_lat = (bbox_wgs84.bounds.iloc[0]['miny'] + bbox_wgs84.bounds.iloc[0]['maxy']) / 2
-center_lon = (bbox_wgs84.bounds.iloc[0]['minx'] + bbox_wgs84.bounds.iloc[0]['maxx']) / 2
-
-# Create the map
-m = folium.Map(location=[center_lat, center_lon], zoom_start=12)
-
-# Add the bounding box rectangle
-folium.GeoJson(
-    bbox_wgs84,
-    style_function=lambda x: {
-        'fillColor': 'red',
-        'color': 'red',
-        'weight': 2,
-        'fillOpacity': 0.1
-    }
-).add_to(m)
-
-# Add some sample points (first 100 points to avoid overcrowding)
-sample_points = gdf.head(3000)
-for idx, row in sample_points.iterrows():
-    # Double-check for NaN values before plotting
-    if not pd.isna(row.geometry.y) and not pd.isna(row.geometry.x):
-        folium.CircleMarker(
-            location=[row.geometry.y, row.geometry.x],
-            radius=3,
-            color='blue',
-            fill=True,
-            fillColor='blue',
-            fillOpacity=0.7
-        ).add_to(m)
-
-# Save the map
-m.save('bounding_box_map.html')
-print("Map saved as 'bounding_box_map.html'") 
\ No newline at end of file
+MAP_HTML = "bounding_box_map.html"
+HOT_AREAS_PATH = Path("data/hot_areas.geojson")
+
+
+def main():
+    """Map the bounding box of all buffered complaints and the footprint of every cluster."""
+    # Load the 311 service requests data (cached lat/lon plus projected x/y, see complaints.py)
+    pts = load_complaints(columns=("lat", "lon", "x", "y"))
+
+    xy = np.column_stack([pts["x"], pts["y"]])     # NY State Plane (ft)
+    with metrics.timer("hot_envelope"):
+        hot_bounds = envelope_bounds(xy, BUFFER_FT)  # minx, miny, maxx, maxy of the 25 ft buffers
+    print(hot_bounds)
+
+    # Hot areas: union of the buffered points of each DBSCAN cluster; the labels are
+    # shared with find_clusters.py and find_top_clusters.py (see clustering.cached_labels)
+    labels = cached_labels(eps=30, min_samples=5)  # 30 ft = ~9 m
+    ids, sizes = np.unique(labels[labels != -1], return_counts=True)
+    with metrics.timer("hot_footprints"):
+        areas = gpd.GeoDataFrame({"cluster": ids, "size": sizes},
+                                 geometry=cluster_footprints(xy, labels, ids, BUFFER_FT),
+                                 crs="EPSG:2263").to_crs("EPSG:4326")
+    HOT_AREAS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    HOT_AREAS_PATH.write_text(areas.to_json())
+    print(f"{len(areas)} hot areas saved to {HOT_AREAS_PATH}")
+    print('end of clustering')
+
+    # Visualization: Create a map showing the bounding box
+    # Convert the bounding box back to WGS84 for mapping
+    bbox_geom = box(*hot_bounds)  # Create rectangle from bounds
+    bbox_gdf = gpd.GeoDataFrame([1], geometry=[bbox_geom], crs="EPSG:2263")
+    bbox_wgs84 = bbox_gdf.to_crs("EPSG:4326")  # Convert to WGS84
+
+    # Get the center point for the map
+    center_lat = (bbox_wgs84.bounds.iloc[0]['miny'] + bbox_wgs84.bounds.iloc[0]['maxy']) / 2
+    center_lon = (bbox_wgs84.bounds.iloc[0]['minx'] + bbox_wgs84.bounds.iloc[0]['maxx']) / 2
+
+    # Create the map
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=12)
+
+    # Add the bounding box rectangle
+    folium.GeoJson(
+        bbox_wgs84,
+        style_function=lambda x: {
+            'fillColor': 'red',
+            'color': 'red',
+            'weight': 2,
+            'fillOpacity': 0.1
+        }
+    ).add_to(m)
+
+    # Add the hot areas, largest first so small ones stay clickable on top
+    folium.GeoJson(
+        areas.sort_values("size", ascending=False),
+        name='Hot areas',
+        style_function=lambda x: {
+            'fillColor': 'orange',
+            'color': 'darkred',
+            'weight': 1,
+            'fillOpacity': 0.5
+        },
+        tooltip=folium.GeoJsonTooltip(fields=['cluster', 'size'], aliases=['Cluster', 'Complaints'])
+    ).add_to(m)
+
+    # Add some sample points (first 3000 points to avoid overcrowding)
+    add_points(m, pts["lat"][:3000], pts["lon"][:3000],
+               colors=['blue'], radius=3, fill_opacity=0.7, name='Complaints')
+
+    # Save the map
+    m.save(MAP_HTML)
+    print(f"Map saved as '{MAP_HTML}'") 
+
+
+if __name__ == "__main__":
+    metrics.run(main)